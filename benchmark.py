@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import fetcher
+import scraper
+from cache import HtmlStore
+
+CORPUS_DIR = os.path.join("bench", "corpus")
+CORPUS_LIST = os.path.join("bench", "corpus.tsv")
+BASELINE_PATH = os.path.join("bench", "baseline.json")
+
+# 年代やレース形態でページの構造が変わるので、それぞれを含むようにする
+CATEGORIES = ["pre1990", "mixed", "obstacle", "scratched", "standard"]
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export = subparsers.add_parser("export")
+    export.add_argument("--start_year", type=int, default=1986)
+    export.add_argument("--end_year", type=int, default=2020)
+    export.add_argument("--cache_dir", type=str, default="html_cache")
+    export.add_argument("--per_category", type=int, default=20)
+    synthesize = subparsers.add_parser("synthesize")
+    synthesize.add_argument("--per_category", type=int, default=10)
+    synthesize.add_argument("--seed", type=int, default=0)
+    run = subparsers.add_parser("run")
+    run.add_argument("--repeat", type=int, default=20)
+    run.add_argument("--tolerance", type=float, default=0.2)
+    run.add_argument("--save_baseline", action="store_true")
+    e2e = subparsers.add_parser("e2e")
+    e2e.add_argument("--backend", choices=["csv", "sqlite"], default="sqlite")
+    e2e.add_argument("--start_year", type=int, default=2019)
+    e2e.add_argument("--end_year", type=int, default=2019)
+    e2e.add_argument("--corpus_dir", type=str, default=CORPUS_DIR)
+    e2e.add_argument("--existing_path", type=str, default=None)
+    e2e.add_argument("--rate", type=float, default=50.0)
+    e2e.add_argument("--max_rate", type=float, default=None)
+    e2e.add_argument("--max_in_flight", type=int, default=4)
+    e2e.add_argument("--parse_workers", type=int, default=None)
+    e2e.add_argument("--latency", type=float, default=0.05)
+    e2e.add_argument("--latency_sigma", type=float, default=0.5)
+    e2e.add_argument("--error_rate", type=float, default=0.0)
+    e2e.add_argument("--throttle_rate", type=float, default=None)
+    e2e.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+def get_category(soup, race_id):
+    race_info = scraper.get_race_info(soup, race_id)
+    rows = soup.find("table", "race_table_01 nk_tb_common").find_all("tr")[1:]
+    if int(race_info["year"]) < 1990:
+        return "pre1990"
+    if race_info["course_type"] == "芝ダ":
+        return "mixed"
+    if race_info["course_direction"] == "障":
+        return "obstacle"
+    if any(not row.find("td").get_text(strip=True).isdecimal() for row in rows):
+        return "scratched"
+    return "standard"
+
+def export(start_year, end_year, cache_dir, per_category):
+    store = HtmlStore(cache_dir)
+    corpus = HtmlStore(CORPUS_DIR)
+    selected = {category: [] for category in CATEGORIES}
+    for race_id, content in store.replay_races(start_year, end_year):
+        soup = scraper.parse_html(content)
+        if soup is None:
+            continue
+        category = get_category(soup, race_id)
+        if len(selected[category]) < per_category:
+            selected[category].append(race_id)
+            corpus.put(race_id, content)
+        if all(len(race_ids) >= per_category for race_ids in selected.values()):
+            break
+    os.makedirs(os.path.dirname(CORPUS_LIST), exist_ok=True)
+    with open(CORPUS_LIST, "w") as f:
+        for category in CATEGORIES:
+            for race_id in selected[category]:
+                f.write("%s\t%s\n" % (race_id, category))
+            print("%-10s %d pages" % (category, len(selected[category])))
+
+def get_synthetic_row(rng, rank, horse_num, horses, last_time):
+    # race_table_01 の1行（21列）
+    gender = rng.choice(scraper.HORSE_GENDERS)
+    weight = rng.randrange(400, 540)
+    goal_time = "" if not rank.isdecimal() else "1:%02d.%d" % (33 + int(rank) // 3, rng.randrange(10))
+    cells = [
+        rank,
+        "<span>%d</span>" % ((horse_num + 1) // 2 if horses > 8 else horse_num),
+        str(horse_num),
+        '<a href="/horse/20%08d/" title="馬%d">ホース%d</a>' % (rng.randrange(10 ** 8), horse_num, horse_num),
+        "%s%d" % (gender, rng.randrange(2, 9)),
+        "%.1f" % rng.choice([54, 55, 56, 57, 58]),
+        '<a href="/jockey/result/recent/01%03d/">騎手%d</a>' % (rng.randrange(1000), rng.randrange(100)),
+        goal_time,
+        "" if rank in ("1", "") else "クビ",
+        "",
+        "3-3-3-3",
+        "<span>%s</span>" % (("%.1f" % rng.uniform(33, 40)) if last_time and goal_time else ""),
+        "%.1f" % rng.uniform(1.5, 200),
+        str(horse_num),
+        "%d(%+d)" % (weight, rng.randrange(-10, 11)) if rng.random() > 0.05 else "計不",
+        "", "", "",
+        '<a href="/trainer/result/recent/01%03d/">調教%d</a>' % (rng.randrange(1000), rng.randrange(100)),
+        "",
+        "%.1f" % rng.uniform(100, 5000) if rank in ("1", "2", "3", "4", "5") else "",
+    ]
+    return "<tr>%s</tr>" % "".join("<td>%s</td>" % cell for cell in cells)
+
+# 芝ダ混合を除いた馬場状態
+STATES = scraper.COURSE_STATES[:4]
+
+def get_synthetic_page(race_id, category, rng):
+    # netkeiba と同じ構造のレースのページを category ごとの特徴を持たせて作る
+    # 実際のページを公開できないので、bench/ にはこのページを置く
+    year = int(race_id[:4])
+    venue = int(race_id[4:6])
+    horses = rng.randrange(8, 19)
+    if category == "mixed":
+        course = "芝ダ右%d0m" % rng.choice([160, 200])
+        state = "芝 : %sダート : %s" % (rng.choice(STATES), rng.choice(STATES))
+    elif category == "obstacle":
+        course = "障芝%d0m" % rng.choice([290, 300, 325, 390])
+        state = "芝 : %s" % rng.choice(STATES)
+    else:
+        course_type = rng.choice(["芝", "ダ"])
+        course = "%s%s%d0m" % (course_type, rng.choice(["左", "右"]), rng.choice([100, 120, 160, 180, 200, 240]))
+        state = "%s : %s" % ({"芝": "芝", "ダ": "ダート"}[course_type], rng.choice(STATES))
+    ranks = [str(rank) for rank in range(1, horses + 1)]
+    if category == "scratched":
+        ranks[-1] = "取"
+        ranks[-2] = "除"
+    rows = [get_synthetic_row(rng, rank, horse_num, horses, category != "pre1990")
+            for horse_num, rank in enumerate(ranks, 1)]
+    win = rng.randrange(110, 3000)
+    payouts = [
+        ("tan", "単勝", ["1"], [win]),
+        ("fuku", "複勝", ["1", "2", "3"], [rng.randrange(100, 1000) for _ in range(3)]),
+        ("waku", "枠連", ["1 - 2"], [rng.randrange(200, 5000)]),
+        ("uren", "馬連", ["1 - 2"], [rng.randrange(200, 10000)]),
+    ]
+    payouts2 = []
+    if year >= 1999:
+        payouts2.append(("wide", "ワイド", ["1 - 2", "1 - 3", "2 - 3"],
+                         [rng.randrange(100, 3000) for _ in range(3)]))
+    if year >= 2002:
+        payouts2.append(("utan", "馬単", ["1 → 2"], [rng.randrange(300, 20000)]))
+        payouts2.append(("sanfuku", "三連複", ["1 - 2 - 3"], [rng.randrange(500, 50000)]))
+    if year >= 2004:
+        payouts2.append(("santan", "三連単", ["1 → 2 → 3"], [rng.randrange(1000, 500000)]))
+
+    def to_table(payouts):
+        return '<table class="pay_table_01" summary="払戻し">%s</table>' % "".join(
+            '<tr><th class="%s">%s</th><td>%s</td><td>%s</td><td>%s</td></tr>' % (
+                css, name, "<br />".join(numbers), "<br />".join("{:,}".format(value) for value in values),
+                "<br />".join(str(i + 1) for i in range(len(values))))
+            for css, name, numbers, values in payouts)
+
+    return """<html><head><meta charset="EUC-JP"><title>%(year)d年 レース結果</title></head><body>
+<div id="page"><div class="menu"><a href="/">トップ</a></div>
+<div class="data_intro"><dl class="racedata fc"><dt>%(race_number)d R</dt><dd><h1>%(race_name)s</h1>
+<p><diary_snap_cut><span>%(course)s&nbsp;/&nbsp;天候 : %(weather)s&nbsp;/&nbsp;%(state)s&nbsp;/&nbsp;発走 : 15:25</span></diary_snap_cut></p></dd></dl>
+<p class="smalltxt">%(year)d年%(month)d月%(day)d日 %(kai)d回%(venue)s%(nichi)d日目 3歳以上オープン  (国際)(指)(定量)</p></div>
+<table class="race_table_01 nk_tb_common" summary="レース結果"><tr><th>着順</th><th>枠番</th><th>馬番</th></tr>
+%(rows)s</table>
+<dl class="pay_block"><dt>払い戻し</dt><dd>%(payouts)s%(payouts2)s</dd></dl>
+<div class="ad">広告</div></div></body></html>""" % {
+        "year": year, "month": rng.randrange(1, 13), "day": rng.randrange(1, 29),
+        "race_number": int(race_id[10:]), "race_name": "%sステークス" % scraper.VENUE_NAMES[venue - 1],
+        "course": course, "weather": rng.choice(scraper.WEATHERS), "state": state,
+        "kai": int(race_id[6:8]), "venue": scraper.VENUE_NAMES[venue - 1], "nichi": int(race_id[8:10]),
+        "rows": "\n".join(rows), "payouts": to_table(payouts), "payouts2": to_table(payouts2),
+    }
+
+def synthesize(per_category, seed):
+    # 実際のページの代わりに、各 category のページを per_category 件ずつ作って bench/ に保存する
+    rng = random.Random(seed)
+    corpus = HtmlStore(CORPUS_DIR)
+    # stub_server で探索できるように、各 category は1つの開催場所の1回1日目からの連番にする
+    years = {"pre1990": 1988, "mixed": 1995, "obstacle": 2010, "scratched": 2015, "standard": 2019}
+    race_ids = []
+    for venue, category in enumerate(CATEGORIES, 5):
+        for i in range(per_category):
+            race_id = "%d%02d01%02d%02d" % (years[category], venue, i // 12 + 1, i % 12 + 1)
+            content = get_synthetic_page(race_id, category, rng).encode("euc_jp")
+            if get_category(scraper.parse_html(content), race_id) != category:
+                raise ValueError("Synthetic page %s is not %s" % (race_id, category))
+            corpus.put(race_id, content)
+            race_ids.append((race_id, category))
+    with open(CORPUS_LIST, "w") as f:
+        for race_id, category in race_ids:
+            f.write("%s\t%s\n" % (race_id, category))
+    print("Saved %d pages to %s" % (len(race_ids), CORPUS_DIR))
+
+def load_corpus():
+    corpus = HtmlStore(CORPUS_DIR)
+    with open(CORPUS_LIST) as f:
+        race_ids = [line.split("\t")[0] for line in f if line.strip()]
+    return [(race_id, corpus.get(race_id)) for race_id in race_ids]
+
+def get_stages(pages):
+    soups = [(race_id, scraper.parse_html(content)) for race_id, content in pages]
+    tables = [(race_id,
+               soup.find("table", "race_table_01 nk_tb_common").find_all("tr"),
+               scraper.get_payouts(soup.find_all("table", "pay_table_01"), race_id))
+              for race_id, soup in soups]
+    return {
+        "parse_html": lambda: [scraper.parse_html(content) for _, content in pages],
+        "get_race_info": lambda: [scraper.get_race_info(soup, race_id) for race_id, soup in soups],
+        "get_refunds": lambda: [scraper.get_refunds(soup.find_all("table", "pay_table_01"))
+                                for _, soup in soups],
+        "get_payouts": lambda: [scraper.get_payouts(soup.find_all("table", "pay_table_01"), race_id)
+                                for race_id, soup in soups],
+        "get_race_records": lambda: [scraper.get_race_records(table, payouts, race_id)
+                                     for race_id, table, payouts in tables],
+        "collect_data": lambda: [scraper.collect_data(soup, race_id) for race_id, soup in soups],
+    }
+
+def get_calibration():
+    # マシンの速さを測るための、スクレイパーのコードにもコーパスにもよらない決まった処理
+    # 各関数の速さはこれに対する比で baseline と比べるので、別のマシンでも同じ baseline を使える
+    rng = random.Random(0)
+    words = ["%08x" % rng.getrandbits(32) for _ in range(2000)]
+
+    def calibration():
+        counts = {}
+        for word in words:
+            counts[word[:2]] = counts.get(word[:2], 0) + int(word, 16) % 7
+        return sorted(words, key=lambda word: word[::-1]), ",".join(words).split(","), counts
+
+    return calibration
+
+def get_number(stage, min_time):
+    # コーパスが小さいので、1回の計測が min_time 秒以上になるまで number 回ずつ呼んでばらつきを抑える
+    number = 1
+    while True:
+        time_start = time.perf_counter()
+        for _ in range(number):
+            stage()
+        if time.perf_counter() - time_start >= min_time:
+            return number
+        number *= 2
+
+def get_time(stage, number):
+    time_start = time.perf_counter()
+    for _ in range(number):
+        stage()
+    return (time.perf_counter() - time_start) / number
+
+def measure(stage, repeat, calibration, min_time=0.05):
+    # 計測中にマシンの速さが変わることがあるので、短い計測ごとに続けてキャリブレーションも測り、その比を使う
+    number = get_number(stage, min_time)
+    calibration_number = get_number(calibration, min_time)
+    times = []
+    ratios = []
+    for _ in range(repeat):
+        times.append(get_time(stage, number))
+        ratios.append(get_time(calibration, calibration_number) / times[-1])
+    # 計測が遅くなるので、メモリ確保量は時間とは別に1回だけ測る
+    tracemalloc.start()
+    stage()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # 比は外れ値に引きずられないように中央値にする
+    return min(times), sorted(ratios)[len(ratios) // 2], peak
+
+def run(repeat, tolerance, save_baseline):
+    pages = load_corpus()
+    rows = sum(len(scraper.collect_data(scraper.parse_html(content), race_id)[1])
+               for race_id, content in pages)
+    calibration = get_calibration()
+    results = {}
+    print("%-18s %10s %10s %10s %14s" % ("stage", "pages/s", "rows/s", "relative", "peak KiB/page"))
+    for name, stage in get_stages(pages).items():
+        elapsed_time, ratio, peak = measure(stage, repeat, calibration)
+        results[name] = {
+            "pages_per_sec": len(pages) / elapsed_time,
+            "rows_per_sec": rows / elapsed_time,
+            # キャリブレーションの処理1回の間に処理できるページ数
+            "relative_speed": len(pages) * ratio,
+            "peak_kib_per_page": peak / 1024 / len(pages),
+        }
+        print("%-18s %10.1f %10.1f %10.3f %14.1f" % (name, results[name]["pages_per_sec"],
+                                                    results[name]["rows_per_sec"],
+                                                    results[name]["relative_speed"],
+                                                    results[name]["peak_kib_per_page"]))
+
+    if save_baseline:
+        with open(BASELINE_PATH, "w") as f:
+            json.dump(results, f, indent=2)
+        print("Saved baseline to %s" % BASELINE_PATH)
+        return True
+    if not os.path.isfile(BASELINE_PATH):
+        print("\033[31mNo baseline at %s, run with --save_baseline first\033[0m" % BASELINE_PATH)
+        return False
+
+    with open(BASELINE_PATH) as f:
+        baseline = json.load(f)
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        # pages/s はマシンによって違うので、キャリブレーションに対する比で比べる
+        if result["relative_speed"] < baseline[name]["relative_speed"] * (1 - tolerance):
+            regressions.append("%s: %.3f relative speed (baseline %.3f)"
+                               % (name, result["relative_speed"], baseline[name]["relative_speed"]))
+        if result["peak_kib_per_page"] > baseline[name]["peak_kib_per_page"] * (1 + tolerance):
+            regressions.append("%s: %.1f KiB/page (baseline %.1f)"
+                               % (name, result["peak_kib_per_page"],
+                                  baseline[name]["peak_kib_per_page"]))
+    for regression in regressions:
+        print("\033[31mRegression %s\033[0m" % regression)
+    return not regressions
+
+def run_e2e(backend, start_year, end_year, server, rate, max_rate, max_in_flight, parse_workers):
+    # 一時ディレクトリに保存し、保存できたレースの race_id を返す
+    with tempfile.TemporaryDirectory() as tmpdir, open(os.devnull, "w") as devnull, \
+         contextlib.redirect_stdout(devnull):
+        options = {"cache_dir": None, "missing_path": None, "validators_path": None,
+                   "parse_workers": parse_workers, "base_url": server.base_url,
+                   "max_rate": max_rate}
+        if backend == "csv":
+            import scraping_csv
+            csvpath = {name: os.path.join(tmpdir, name + ".csv")
+                       for name in ["info", "data", "payout"]}
+            scraping_csv.scraping(start_year, end_year, csvpath, rate, max_in_flight, **options)
+            # ページの年は race_id の年と違うことがある（corpus のページを使い回すため）
+            return set(scraping_csv.get_exist_race_ids(0, 9999, csvpath))
+        import scraping_sqlite
+        dbpath = os.path.join(tmpdir, "netkeiba.db")
+        scraping_sqlite.init_database(dbpath)
+        scraping_sqlite.scraping(start_year, end_year, dbpath, rate, max_in_flight, **options)
+        return set(scraping_sqlite.get_exist_race_ids(0, 9999, dbpath))
+
+def e2e(backend, start_year, end_year, corpus_dir, existing_path, rate, max_rate, max_in_flight,
+        parse_workers, latency, latency_sigma, error_rate, throttle_rate, seed):
+    # stub_server を立てて実際のドライバで探索し、スループットと無駄なリクエストを測る
+    from stub_server import StubServer, load_existing
+    existing = load_existing(existing_path) if existing_path else None
+    server = StubServer(corpus_dir, existing, latency, latency_sigma, error_rate, throttle_rate,
+                        seed=seed).start()
+    expected = {race_id for race_id in server.existing
+                if start_year <= int(race_id[:4]) <= end_year}
+    time_start = time.perf_counter()
+    try:
+        stored = run_e2e(backend, start_year, end_year, server, rate, max_rate, max_in_flight,
+                         parse_workers)
+    finally:
+        server.shutdown()
+    elapsed_time = time.perf_counter() - time_start
+    stats = server.get_stats()
+
+    print("backend            %s" % backend)
+    print("elapsed            %.1f sec" % elapsed_time)
+    print("stored races       %d of %d" % (len(stored), len(expected)))
+    print("races/s            %.2f" % (len(stored) / elapsed_time))
+    print("requests           %d (%s)" % (stats["requests"], ", ".join(
+        "%s %d" % (key, value) for key, value in sorted(stats.items())
+        if key not in ("requests", "peak_per_sec"))))
+    print("wasted/race        %.2f" % ((stats["requests"] - len(stored)) / max(len(stored), 1)))
+    # 調整された rate は max_rate（デフォルトは rate）を超えない
+    max_rate = fetcher.get_max_rate(rate, max_rate)
+    print("peak requests/s    %d (max rate %.1f)" % (stats["peak_per_sec"], max_rate))
+    return stored >= expected and stats["peak_per_sec"] <= max_rate + 1
+
+if __name__ == "__main__":
+    ARGS = get_args()
+    if ARGS.command == "export":
+        export(ARGS.start_year, ARGS.end_year, ARGS.cache_dir, ARGS.per_category)
+    elif ARGS.command == "synthesize":
+        synthesize(ARGS.per_category, ARGS.seed)
+    elif ARGS.command == "e2e":
+        if not e2e(ARGS.backend, ARGS.start_year, ARGS.end_year, ARGS.corpus_dir,
+                   ARGS.existing_path, ARGS.rate, ARGS.max_rate, ARGS.max_in_flight,
+                   ARGS.parse_workers, ARGS.latency, ARGS.latency_sigma, ARGS.error_rate,
+                   ARGS.throttle_rate, ARGS.seed):
+            sys.exit(1)
+    elif not run(ARGS.repeat, ARGS.tolerance, ARGS.save_baseline):
+        sys.exit(1)
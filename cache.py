@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import gzip
+import os
+import struct
+import threading
+import time
+
+HEADER = struct.Struct(">12sI")
+
+class HtmlStore:
+    # race_id の先頭6桁（年 + 開催場所）ごとに1つのファイルにまとめ、
+    # [race_id(12バイト) | 長さ(4バイト) | gzip 圧縮した html] を追記していく
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+        self.indexes = {}
+
+    def get_path(self, shard):
+        return os.path.join(self.root, shard[:4], shard + ".pack")
+
+    def load_index(self, shard):
+        if shard in self.indexes:
+            return self.indexes[shard]
+        index = {}
+        end = 0
+        path = self.get_path(shard)
+        if os.path.isfile(path):
+            with open(path, "rb") as f:
+                while True:
+                    header = f.read(HEADER.size)
+                    if len(header) < HEADER.size:
+                        break
+                    race_id, length = HEADER.unpack(header)
+                    offset = f.tell()
+                    if len(f.read(length)) < length:
+                        break
+                    # 12桁より短いキー（馬ID）は NUL で埋められている
+                    index[race_id.rstrip(b"\0").decode()] = (offset, length)
+                    end = offset + length
+            # 書き込み途中で落ちた末尾のレコードは捨てる
+            if os.path.getsize(path) > end:
+                with open(path, "r+b") as f:
+                    f.truncate(end)
+        self.indexes[shard] = index
+        return index
+
+    def __contains__(self, race_id):
+        race_id = str(race_id)
+        with self.lock:
+            return race_id in self.load_index(race_id[:6])
+
+    def get(self, race_id):
+        race_id = str(race_id)
+        with self.lock:
+            entry = self.load_index(race_id[:6]).get(race_id)
+        if entry is None:
+            return None
+        offset, length = entry
+        with open(self.get_path(race_id[:6]), "rb") as f:
+            f.seek(offset)
+            return gzip.decompress(f.read(length))
+
+    def put(self, race_id, content, replace=False):
+        # replace なら同じ race_id のレコードを追記し、以後はそちらを読む（古いレコードは残る）
+        race_id = str(race_id)
+        data = gzip.compress(content)
+        with self.lock:
+            index = self.load_index(race_id[:6])
+            if race_id in index and not replace:
+                return
+            path = self.get_path(race_id[:6])
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "ab") as f:
+                f.write(HEADER.pack(race_id.encode(), len(data)))
+                offset = f.tell()
+                f.write(data)
+            index[race_id] = (offset, len(data))
+
+    def race_ids(self, start_year, end_year):
+        race_ids = []
+        for y in range(start_year, end_year + 1):
+            for v in range(1, 11):
+                shard = f"{y}{v:02}"
+                with self.lock:
+                    race_ids += list(self.load_index(shard))
+        return sorted(race_ids)
+
+    def replay_races(self, start_year, end_year, exist_race_ids=()):
+        exist_race_ids = set(exist_race_ids)
+        for race_id in self.race_ids(start_year, end_year):
+            if race_id not in exist_race_ids:
+                yield race_id, self.get(race_id)
+
+class MissingRaceIds:
+    # 存在しなかった race_id と確認した時刻を追記していくファイル
+    # 確認した時点で既にその年が終わっていれば以後は再確認しない
+    # その年のうちに確認したもの（これから開催されうるもの）は recheck_days 日後に再確認する
+    def __init__(self, path, recheck_days=7):
+        self.path = path
+        self.recheck_seconds = recheck_days * 24 * 60 * 60
+        self.lock = threading.Lock()
+        self.checked_at = {}
+        if os.path.isfile(path):
+            with open(path) as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) == 2:
+                        self.checked_at[fields[0]] = float(fields[1])
+
+    def __contains__(self, race_id):
+        race_id = str(race_id)
+        checked_at = self.checked_at.get(race_id)
+        if checked_at is None:
+            return False
+        if time.localtime(checked_at).tm_year > int(race_id[:4]):
+            return True
+        return time.time() - checked_at < self.recheck_seconds
+
+    def add(self, race_id):
+        race_id = str(race_id)
+        checked_at = time.time()
+        with self.lock:
+            self.checked_at[race_id] = checked_at
+            with open(self.path, "a") as f:
+                f.write("%s\t%d\n" % (race_id, checked_at))
+
+class PageValidators:
+    # race_id ごとに ETag、Last-Modified、内容の SHA-1 を追記していくファイル
+    # 同じ race_id の行は後のものが優先される
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.validators = {}
+        if os.path.isfile(path):
+            with open(path) as f:
+                for line in f:
+                    fields = line.rstrip("\n").split("\t")
+                    if len(fields) == 4:
+                        self.validators[fields[0]] = tuple(fields[1:])
+
+    def get(self, race_id):
+        return self.validators.get(str(race_id), ("", "", ""))
+
+    def set(self, race_id, etag, last_modified, digest):
+        race_id = str(race_id)
+        validators = (etag, last_modified, digest)
+        with self.lock:
+            if self.validators.get(race_id) == validators:
+                return
+            self.validators[race_id] = validators
+            with open(self.path, "a") as f:
+                f.write("%s\t%s\t%s\t%s\n" % ((race_id,) + validators))
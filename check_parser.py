@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import argparse
+import json
+import os
+import sys
+import time
+import scraper
+from cache import HtmlStore
+
+# 通常のレース・中止になったレース・結果の表がないページ・同着の払い戻しのページと、その正解
+FIXTURES_DIR = "fixtures"
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--start_year", type=int, default=1986)
+    parser.add_argument("--end_year", type=int, default=2020)
+    parser.add_argument("--cache_dir", type=str, default="html_cache")
+    parser.add_argument("--parser", type=str, default=scraper.PARSER)
+    parser.add_argument("--fixtures_dir", type=str, default=FIXTURES_DIR)
+    parser.add_argument("--add_fixture", nargs=2, metavar=("NAME", "RACE_ID"), default=None)
+    return parser.parse_args()
+
+def parse(content, race_id, parser, parse_only=scraper.PARSE_REGIONS):
+    soup = scraper.parse_html(content, parser, parse_only)
+    return None if soup is None else scraper.collect_data(soup, race_id)
+
+def to_json(result):
+    # collect_data の結果を json に保存できる形にする（結果の表がないページは None）
+    if result is None:
+        return None
+    race_info, race_records, payouts = result
+    return {
+        "race_info": race_info._asdict(),
+        "race_records": [record._asdict() for record in race_records],
+        "payouts": [payout._asdict() for payout in payouts],
+    }
+
+def add_fixture(fixtures_dir, name, race_id, content):
+    # html.parser で全体を木にした結果を正解として、ページと一緒に保存する
+    os.makedirs(fixtures_dir, exist_ok=True)
+    with open(os.path.join(fixtures_dir, name + ".html"), "wb") as f:
+        f.write(content)
+    with open(os.path.join(fixtures_dir, name + ".json"), "w", encoding="utf-8") as f:
+        json.dump({"race_id": str(race_id),
+                   "expected": to_json(parse(content, race_id, "html.parser", None))},
+                  f, ensure_ascii=False, indent=1)
+        f.write("\n")
+
+def check_fixtures(fixtures_dir, parser):
+    # 保存したページを従来の方法と指定したパーサの両方でパースし、保存した正解と一致するか確かめる
+    names = sorted(name[:-len(".json")] for name in os.listdir(fixtures_dir) if name.endswith(".json"))
+    mismatches = []
+    for name in names:
+        with open(os.path.join(fixtures_dir, name + ".json"), encoding="utf-8") as f:
+            fixture = json.load(f)
+        with open(os.path.join(fixtures_dir, name + ".html"), "rb") as f:
+            content = f.read()
+        for parser_name, parse_only in (("html.parser", None), (parser, scraper.PARSE_REGIONS)):
+            if to_json(parse(content, fixture["race_id"], parser_name, parse_only)) != fixture["expected"]:
+                mismatches.append(name)
+                print("Mismatch fixture %s with %s" % (name, parser_name))
+    print("Checked %d fixtures, %d mismatches" % (len(names), len(mismatches)))
+    return mismatches
+
+def check(start_year, end_year, cache_dir, parser):
+    # html.parser で全体を木にした従来の結果を正解として、
+    # 指定したパーサで対象部分だけを木にした結果と一致するか確かめる
+    store = HtmlStore(cache_dir)
+    elapsed = {"golden": 0.0, parser: 0.0}
+    mismatches = []
+    pages = 0
+    for race_id, content in store.replay_races(start_year, end_year):
+        time_start = time.perf_counter()
+        soup = scraper.parse_html(content, "html.parser", None)
+        golden = scraper.collect_data(soup, race_id)
+        elapsed["golden"] += time.perf_counter() - time_start
+
+        time_start = time.perf_counter()
+        soup = scraper.parse_html(content, parser)
+        result = scraper.collect_data(soup, race_id)
+        elapsed[parser] += time.perf_counter() - time_start
+
+        pages += 1
+        if golden != result:
+            mismatches.append(race_id)
+            print("Mismatch race_id %s" % race_id)
+
+    for name, seconds in elapsed.items():
+        print("%-12s %8.1f pages/s" % (name, pages / seconds if seconds else 0))
+    print("Checked %d pages, %d mismatches" % (pages, len(mismatches)))
+    return mismatches
+
+if __name__ == "__main__":
+    ARGS = get_args()
+    if ARGS.add_fixture:
+        name, race_id = ARGS.add_fixture
+        content = HtmlStore(ARGS.cache_dir).get(race_id)
+        if content is None:
+            sys.exit("race_id %s is not in %s" % (race_id, ARGS.cache_dir))
+        add_fixture(ARGS.fixtures_dir, name, race_id, content)
+        sys.exit()
+    mismatches = check_fixtures(ARGS.fixtures_dir, ARGS.parser)
+    # html_cache があれば、保存済みの全てのページでも確かめる
+    if ARGS.cache_dir and os.path.isdir(ARGS.cache_dir):
+        mismatches += check(ARGS.start_year, ARGS.end_year, ARGS.cache_dir, ARGS.parser)
+    if mismatches:
+        sys.exit(1)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import argparse
+import os
+import sqlite3
+import time
+import numpy as np
+import query
+
+# 出走1回を1行として、日付・race_id・馬番の順に並べた列を読む
+# rowid（race_result の result_id）は追加・置き換えられたレースだけを読み直すために使う
+LOAD_SQL = """
+    SELECT r.result_id AS rowid, r.race_id, %s, h.horse_id,
+           COALESCE(r.jockey_key, 0) AS jockey_key, COALESCE(r.trainer_key, 0) AS trainer_key,
+           r.horse_num, i.venue, i.course_type, i.course_distance, i.course_state,
+           r.rank, r.goal_time, r.last_time, r.odds, r.popularity, r.horse_weight, r.prize
+    FROM race_result r
+    JOIN horse h ON h.horse_key = r.horse_key
+    JOIN race_info i ON i.race_id = r.race_id
+    WHERE r.result_id > ?
+""" % query.DATE
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dbpath", type=str, default="netkeiba.db")
+    parser.add_argument("--output", type=str, default="features.npz")
+    parser.add_argument("--rebuild", action="store_true")
+    return parser.parse_args()
+
+def load(dbpath, after_rowid=0):
+    connection = sqlite3.connect(dbpath)
+    data = query.to_columns(connection.execute(LOAD_SQL, [after_rowid]))
+    connection.close()
+    return data
+
+def sort_rows(data):
+    order = np.lexsort((data["horse_num"], data["race_id"], data["date"]))
+    return {column: values[order] for column, values in data.items()}
+
+def get_codes(data, by):
+    # by の列の組み合わせごとに整数のコードを振る
+    codes = np.zeros(len(data["race_id"]), dtype=np.int64)
+    for column in by:
+        uniques, inverse = np.unique(data[column], return_inverse=True)
+        codes = codes * len(uniques) + inverse
+    return codes
+
+def sort_groups(codes):
+    # 行の順番（日付順）を保ったままグループごとに並べ、各行のグループの先頭の位置を返す
+    order = np.argsort(codes, kind="stable")
+    sorted_codes = codes[order]
+    starts = np.r_[True, sorted_codes[1:] != sorted_codes[:-1]]
+    group_start = np.maximum.accumulate(np.where(starts, np.arange(len(codes)), 0))
+    return order, group_start
+
+def unsort(order, values):
+    result = np.empty_like(values)
+    result[order] = values
+    return result
+
+def rolling_mean(data, column, codes, window):
+    # 同じグループの直前 window 回の平均（その行自身は含まず、NaN は除く）
+    order, group_start = sort_groups(codes)
+    values = data[column][order].astype(np.float64)
+    valid = ~np.isnan(values)
+    sums = np.r_[0, np.cumsum(np.where(valid, values, 0))]
+    counts = np.r_[0, np.cumsum(valid)]
+    index = np.arange(len(values))
+    start = np.maximum(index - window, group_start)
+    with np.errstate(invalid="ignore"):
+        mean = (sums[index] - sums[start]) / (counts[index] - counts[start])
+    return unsort(order, mean)
+
+def ewm_mean(data, column, codes, halflife):
+    # 同じグループのそれまでの値を、経過日数 halflife 日で重みが半分になるように平均する
+    order, group_start = sort_groups(codes)
+    values = data[column][order].astype(np.float64)
+    days = data["date"][order].astype(np.int64)
+    valid = ~np.isnan(values)
+    values = np.where(valid, values, 0)
+    position = np.arange(len(values)) - group_start
+    decay = np.ones(len(values))
+    decay[1:] = 0.5 ** ((days[1:] - days[:-1]) / halflife)
+    sums = np.zeros(len(values))
+    weights = np.zeros(len(values))
+    # グループ内で k 回目の行をまとめて、前の行から漸化式で求める
+    by_position = np.argsort(position, kind="stable")
+    bounds = np.r_[0, np.cumsum(np.bincount(position))]
+    for k in range(1, len(bounds) - 1):
+        rows = by_position[bounds[k]:bounds[k + 1]]
+        sums[rows] = (sums[rows - 1] + values[rows - 1]) * decay[rows]
+        weights[rows] = (weights[rows - 1] + valid[rows - 1]) * decay[rows]
+    with np.errstate(invalid="ignore"):
+        mean = sums / weights
+    return unsort(order, mean)
+
+def days_since_last(data, column, codes):
+    # 同じグループの前回からの日数
+    order, group_start = sort_groups(codes)
+    days = data["date"][order].astype(np.int64).astype(np.float64)
+    result = np.full(len(days), np.nan)
+    result[1:] = days[1:] - days[:-1]
+    result[group_start == np.arange(len(days))] = np.nan
+    return unsort(order, result)
+
+def leave_one_out_mean(data, column, codes):
+    # 同じグループの、そのレースを除いた全ての行の平均
+    values = data[column].astype(np.float64)
+    valid = ~np.isnan(values)
+    values = np.where(valid, values, 0)
+    _, group = np.unique(codes, return_inverse=True)
+    _, race = np.unique(data["race_id"], return_inverse=True)
+    _, pair = np.unique(group * (race.max() + 1) + race, return_inverse=True)
+    total = np.bincount(group, values)[group] - np.bincount(pair, values)[pair]
+    count = np.bincount(group, valid)[group] - np.bincount(pair, valid)[pair]
+    with np.errstate(invalid="ignore"):
+        return total / count
+
+# (特徴量の名前, 関数, 値の列, グループの列, 引数)
+FEATURES = [
+    ("days_since_last",    days_since_last,    None,        ["horse_id"], {}),
+    ("rank_mean5",         rolling_mean,       "rank",      ["horse_id"], {"window": 5}),
+    ("goal_time_mean5",    rolling_mean,       "goal_time",
+     ["horse_id", "course_type", "course_distance"], {"window": 5}),
+    ("last_time_mean5",    rolling_mean,       "last_time", ["horse_id"], {"window": 5}),
+    ("prize_mean5",        rolling_mean,       "prize",     ["horse_id"], {"window": 5}),
+    ("rank_ewm",           ewm_mean,           "rank",      ["horse_id"], {"halflife": 180}),
+    ("last_time_ewm",      ewm_mean,           "last_time", ["horse_id"], {"halflife": 180}),
+    ("jockey_rank_loo",    leave_one_out_mean, "rank",      ["jockey_key"], {}),
+    ("trainer_rank_loo",   leave_one_out_mean, "rank",      ["trainer_key"], {}),
+]
+
+class FeatureEngine:
+    # race_data を日付順に並べた NumPy 配列として持ち、FEATURES の列を加える
+    # 各特徴量は同じグループの行だけから決まるので、追加したレースと同じグループの行だけを計算し直す
+    def __init__(self, features=FEATURES):
+        self.features = features
+        self.data = None
+        self.last_rowid = 0
+
+    def build(self, dbpath):
+        self.data = sort_rows(load(dbpath))
+        self.last_rowid = int(self.data["rowid"].max(initial=0))
+        for name, function, column, by, kwargs in self.features:
+            self.data[name] = function(self.data, column, get_codes(self.data, by), **kwargs)
+        return len(self.data["race_id"])
+
+    def update(self, dbpath):
+        # 前回から追加された行を読み、関係するグループの特徴量を計算し直す
+        new = load(dbpath, self.last_rowid)
+        if len(new["race_id"]) == 0:
+            return 0
+        # 置き換えられたレース（--refresh_weeks）は古い行を捨てる
+        keep = ~np.isin(self.data["race_id"], new["race_id"])
+        for name, _, _, _, _ in self.features:
+            new[name] = np.full(len(new["race_id"]), np.nan)
+        data = {column: np.concatenate([self.data[column][keep], new[column]]) for column in new}
+        data["is_new"] = np.r_[np.zeros(keep.sum(), dtype=bool), np.ones(len(new["race_id"]), dtype=bool)]
+        data = sort_rows(data)
+        is_new = data.pop("is_new")
+        for name, function, column, by, kwargs in self.features:
+            codes = get_codes(data, by)
+            affected = np.isin(codes, codes[is_new])
+            subset = {key: values[affected] for key, values in data.items()}
+            data[name][affected] = function(subset, column, codes[affected], **kwargs)
+        self.data = data
+        self.last_rowid = int(data["rowid"].max())
+        return len(new["race_id"])
+
+    def save(self, path):
+        np.savez(path, last_rowid=self.last_rowid, **self.data)
+
+    def restore(self, path):
+        with np.load(path, allow_pickle=True) as saved:
+            self.last_rowid = int(saved["last_rowid"])
+            self.data = {column: saved[column] for column in saved.files if column != "last_rowid"}
+
+if __name__ == "__main__":
+    ARGS = get_args()
+    engine = FeatureEngine()
+    time_start = time.perf_counter()
+    if os.path.isfile(ARGS.output) and not ARGS.rebuild:
+        engine.restore(ARGS.output)
+        count = engine.update(ARGS.dbpath)
+        print("Updated features with %d new rows" % count)
+    else:
+        count = engine.build(ARGS.dbpath)
+        print("Built features for %d rows" % count)
+    engine.save(ARGS.output)
+    print("Elapsed time %.1f sec" % (time.perf_counter() - time_start))
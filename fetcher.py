@@ -0,0 +1,476 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import collections
+import queue
+import random
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+import metrics
+import scraper
+
+class RateLimiter:
+    # トークンバケット: rate 個/秒でトークンが補充され、最大 burst 個まで溜まる
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.timestamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.timestamp) * self.rate)
+                self.timestamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def update_rate(self, update):
+        # update は今の rate を受け取り、新しい rate を返す関数
+        with self.lock:
+            self.rate = update(self.rate)
+            return self.rate
+
+def get_median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+class AimdController:
+    # 応答を見て limiter の rate を加算増加・乗算減少（AIMD）で調整する
+    # 問題がなければ1秒あたり increase（デフォルトは max_rate の 1/20）ずつ max_rate まで上げ、
+    # スロットリングされたとき、直近 window 件の一時的なエラーが error_threshold を超えたとき、
+    # 直近 window 件の応答時間の中央値が、直近 baseline_window 件の中央値の latency_factor 倍を超えたときに
+    # decrease 倍にする
+    # 応答時間は大きさが違う存在しないページを除き、レースのページだけで比べる
+    # 下げた直後は応答が反映されるまで window 件の間は続けて下げない
+    def __init__(self, limiter, max_rate, min_rate=0.05, increase=None, decrease=0.5, window=20,
+                 error_threshold=0.1, latency_factor=3.0, min_latency=0.05, baseline_window=200):
+        self.limiter = limiter
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.increase = increase or max_rate / 20
+        self.decrease = decrease
+        self.window = window
+        self.error_threshold = error_threshold
+        self.latency_factor = latency_factor
+        self.min_latency = min_latency
+        self.lock = threading.Lock()
+        self.results = collections.deque(maxlen=window)
+        self.latencies = collections.deque(maxlen=baseline_window)
+        self.since_decrease = window
+
+    def is_slow(self):
+        if len(self.latencies) < 2 * self.window:
+            return False
+        recent = get_median(list(self.latencies)[-self.window:])
+        return recent > self.latency_factor * max(get_median(self.latencies), self.min_latency)
+
+    def observe(self, kind, latency):
+        with self.lock:
+            self.since_decrease += 1
+            self.results.append(kind == "transient")
+            if kind == "exists":
+                self.latencies.append(latency)
+            errors = sum(self.results) / len(self.results)
+            if kind == "throttled" or errors > self.error_threshold or self.is_slow():
+                if self.since_decrease < self.window:
+                    return
+                self.since_decrease = 0
+                self.results.clear()
+                metrics.inc("rate_changes_total", direction="decrease")
+                update = lambda rate: max(self.min_rate, rate * self.decrease)
+            elif kind not in ("transient", "fatal"):
+                update = lambda rate: min(self.max_rate, rate + self.increase / rate)
+            else:
+                return
+        # SharedRateLimiter では他のプロセスの調整も反映された rate を更新する
+        self.limiter.update_rate(update)
+
+class FetchError(Exception):
+    def __init__(self, url, kind):
+        super().__init__("%s after retries for %s" % (kind, url))
+        self.url = url
+        self.kind = kind
+
+class Stopped(Exception):
+    # run_shards の呼び出し側が止めたので、スレッドのリクエストを打ち切る
+    pass
+
+def classify(response, has_content=scraper.has_race_table):
+    # exists: 内容のあるページ（304 を含む）、missing: 内容のない 200 のページ（存在しない race_id）、
+    # throttled: リクエストが多すぎるか（429）、一時的に拒否された（403）、
+    # transient: サーバのエラー、fatal: 再試行しても変わらないそれ以外のエラー
+    status = response.status_code
+    if status in (429, 403):
+        return "throttled"
+    if status >= 500 or status == 408:
+        return "transient"
+    if status == 304:
+        return "exists"
+    if status == 200:
+        return "exists" if has_content(response.content) else "missing"
+    return "fatal"
+
+def get_retry_after(response):
+    try:
+        return float(response.headers.get("Retry-After", 0))
+    except ValueError:
+        # 日付で指定された場合は使わない
+        return 0
+
+def get_max_rate(rate, max_rate=None):
+    # 指定がなければ rate より上げない（下げたあとに rate まで戻すだけ）
+    return max(max_rate or rate, rate)
+
+def get_next_shard(shards):
+    shards = iter(shards)
+    lock = threading.Lock()
+
+    def next_shard():
+        with lock:
+            return next(shards, None)
+
+    return next_shard
+
+class Fetcher:
+    def __init__(self, rate=1.0, max_in_flight=4, store=None, missing=None, limiter=None,
+                 validators=None, base_url=scraper.URL_BASE, max_rate=None, timeout=(10, 30),
+                 max_retries=4, backoff_base=1.0, backoff_max=60.0, horse_store=None):
+        self.limiter = limiter or RateLimiter(rate)
+        # rate から始めて max_rate（デフォルトは rate）まで調整する
+        self.controller = AimdController(self.limiter, get_max_rate(rate, max_rate))
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_in_flight = max_in_flight
+        self.store = store
+        self.missing = missing
+        self.validators = validators
+        self.base_url = base_url
+        # 馬のページは race/ と同じ階層の horse/ にある
+        self.horse_base_url = urllib.parse.urljoin(base_url, "../horse/")
+        self.horse_store = horse_store
+        # 書き込みが終わるまで保存しない race_id -> (ETag, Last-Modified, ハッシュ)
+        self.pending_validators = {}
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def get_session(self):
+        # スレッドごとにセッションを持ち、keep-alive の接続を使い回す
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            self.local.session = session
+        return session
+
+    def fetch(self, race_id):
+        if self.store is not None:
+            content = self.store.get(race_id)
+            if content is not None:
+                metrics.inc("cache_hits_total")
+                return content
+            metrics.inc("cache_misses_total")
+        if self.missing is not None and race_id in self.missing:
+            metrics.inc("missing_hits_total")
+            return None
+        response = self.get_page(race_id)
+        if not scraper.has_race_table(response.content):
+            metrics.inc("nonexistent_total")
+            if self.missing is not None and response.status_code == 200:
+                self.missing.add(race_id)
+            return None
+        self.save_validators(race_id, response)
+        if self.store is not None:
+            self.store.put(race_id, response.content)
+        return response.content
+
+    def get_page(self, race_id, headers=None):
+        return self.get_url(self.base_url + str(race_id), headers)
+
+    def get_url(self, url, headers=None, has_content=scraper.has_race_table):
+        # 一時的なエラーとスロットリングは、ジッタ付きの指数バックオフで max_retries 回まで再試行する
+        # 404 などの再試行しても変わらないエラーはすぐに FetchError にする
+        for attempt in range(self.max_retries + 1):
+            self.check_stopped()
+            self.limiter.acquire()
+            self.check_stopped()
+            with self.lock:
+                self.requests += 1
+            time_start = time.perf_counter()
+            try:
+                with metrics.timer("fetch"):
+                    response = self.get_session().get(url, headers=headers, timeout=self.timeout)
+            except requests.RequestException:
+                # タイムアウトや接続の切断
+                response = None
+                kind = "transient"
+                metrics.inc("fetch_requests_total", status="exception")
+            else:
+                kind = classify(response, has_content)
+                metrics.inc("fetch_requests_total", status=response.status_code)
+                metrics.inc("fetch_bytes_total", len(response.content))
+            self.controller.observe(kind, time.perf_counter() - time_start)
+            if kind in ("exists", "missing"):
+                return response
+            if kind == "fatal":
+                break
+            if attempt < self.max_retries:
+                metrics.inc("fetch_retries_total", kind=kind)
+                self.wait(self.get_backoff(attempt, response))
+        raise FetchError(url, kind)
+
+    def check_stopped(self):
+        # run_shards のスレッドでは、呼び出し側が止めたらリクエストを送らずに Stopped にする
+        stopped = getattr(self.local, "stopped", None)
+        if stopped is not None and stopped():
+            raise Stopped()
+
+    def wait(self, seconds):
+        # バックオフで待つ間も、止められたかを 0.1 秒ごとに確認する
+        end = time.monotonic() + seconds
+        while True:
+            self.check_stopped()
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                return
+            time.sleep(min(remaining, 0.1))
+
+    def get_backoff(self, attempt, response=None):
+        # full jitter: 0 から base * 2^attempt（最大 backoff_max）までの一様乱数
+        backoff = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        if response is not None:
+            backoff = max(backoff, get_retry_after(response))
+        return backoff
+
+    def fetch_horse(self, horse_id, refresh=False):
+        # 初めて取得する馬はキャッシュがあればそれを使い、refresh なら取得し直してキャッシュを置き換える
+        if self.horse_store is not None and not refresh:
+            content = self.horse_store.get(horse_id)
+            if content is not None:
+                metrics.inc("cache_hits_total", page="horse")
+                return content
+        response = self.get_url(self.horse_base_url + str(horse_id) + "/",
+                                has_content=scraper.has_horse_profile)
+        if not scraper.has_horse_profile(response.content):
+            metrics.inc("nonexistent_total", page="horse")
+            return None
+        if self.horse_store is not None:
+            self.horse_store.put(horse_id, response.content, replace=refresh)
+        return response.content
+
+    def fetch_horses(self, horse_ids, refresh_ids=(), stats=None, chunk_size=100):
+        # 馬のページを chunk_size 頭ずつスレッドで取得し、(horse_id, ページ) を順不同で返す
+        # ページがなかった馬は内容を None として返す
+        refresh_ids = set(refresh_ids)
+        horse_ids = list(horse_ids)
+        chunks = [(horse_ids[i:i + chunk_size],) for i in range(0, len(horse_ids), chunk_size)]
+
+        def discover(horse_ids, shard_stats):
+            shard_stats["fetched"] = 0
+            for horse_id in horse_ids:
+                shard_stats["fetched"] += 1
+                yield horse_id, self.fetch_horse(horse_id, horse_id in refresh_ids)
+
+        return self.run_shards(get_next_shard(chunks), discover, stats)
+
+    def save_validators(self, race_id, response, digest=None):
+        # 書き込む前に保存すると、書き込めなかったときに次の再検証で変わっていないとみなされるので、
+        # commit_validators が呼ばれるまで保存しない
+        if self.validators is not None:
+            with self.lock:
+                self.pending_validators[str(race_id)] = (
+                    response.headers.get("ETag", ""), response.headers.get("Last-Modified", ""),
+                    digest or scraper.get_digest(response.content))
+
+    def commit_validators(self, race_ids):
+        # 書き込みをコミットしたレースの検証子を保存する
+        if self.validators is None:
+            return
+        for race_id in race_ids:
+            with self.lock:
+                validators = self.pending_validators.pop(str(race_id), None)
+            if validators is not None:
+                self.validators.set(race_id, *validators)
+
+    def discard_validators(self, race_ids):
+        # 書き込まなかったレースの検証子は保存せずに捨て、次の再検証で取得し直す
+        with self.lock:
+            for race_id in race_ids:
+                self.pending_validators.pop(str(race_id), None)
+
+    def revalidate(self, race_id):
+        # 条件付き GET で確認し、内容が変わっていれば新しいページを、変わっていなければ None を返す
+        # ETag や Last-Modified を返さないページも、内容のハッシュが同じなら変わっていないとみなす
+        etag, last_modified, digest = ("", "", "")
+        if self.validators is not None:
+            etag, last_modified, digest = self.validators.get(race_id)
+        if not digest and self.store is not None:
+            content = self.store.get(race_id)
+            if content is not None:
+                digest = scraper.get_digest(content)
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        response = self.get_page(race_id, headers)
+        if response.status_code == 304:
+            metrics.inc("revalidated_total", result="not_modified")
+            return None
+        if not scraper.has_race_table(response.content):
+            # エラーページなどで消えたとはみなさない
+            metrics.inc("revalidated_total", result="error")
+            return None
+        new_digest = scraper.get_digest(response.content)
+        self.save_validators(race_id, response, new_digest)
+        if new_digest == digest:
+            # 保存済みの内容と同じなので、書き込みを待たずに新しい ETag などを保存する
+            self.commit_validators([race_id])
+            metrics.inc("revalidated_total", result="unchanged")
+            return None
+        metrics.inc("revalidated_total", result="changed")
+        if self.store is not None:
+            self.store.put(race_id, response.content, replace=True)
+        return response.content
+
+    def discover_races(self, start_year, end_year, exist_race_ids=(), stats=None):
+        # (年, 開催場所) ごとにスレッドで探索し、取得したページを順不同で返す
+        exist_race_ids = set(exist_race_ids)
+        shards = [(y, v) for y in range(start_year, end_year + 1) for v in range(1, 11)]
+
+        def discover(year, venue, shard_stats):
+            return scraper.discover_venue_races(year, venue, self.fetch, exist_race_ids, shard_stats)
+
+        return self.run_shards(get_next_shard(shards), discover, stats)
+
+    def discover_races_after(self, latest_race_ids, start_year, end_year, stats=None):
+        # 開催場所ごとに、保存済みの最新レースの次から探索する
+        # 何も保存されていない開催場所は start_year から探索する
+        shards = [(v,) for v in range(1, 11)]
+
+        def discover(venue, shard_stats):
+            return scraper.discover_venue_races_after(venue, latest_race_ids.get(venue), self.fetch,
+                                                      start_year, end_year, shard_stats)
+
+        return self.run_shards(get_next_shard(shards), discover, stats)
+
+    def discover_jobs(self, jobs, get_exist_race_ids, stats=None):
+        # ジョブテーブルから (年, 開催場所) を借りて探索する
+        # シャードのレースを全て返したあとに、race_id の代わりに (年, 開催場所) を内容なしで返す
+        def discover(year, venue, shard_stats):
+            # 落ちたプロセスが途中まで書き込んだレースは飛ばす
+            exist_race_ids = set(get_exist_race_ids(year))
+            try:
+                for item in scraper.discover_venue_races(year, venue, self.fetch, exist_race_ids,
+                                                         shard_stats):
+                    if (year, venue) not in jobs.held:
+                        # リースが切れて他のプロセスに取られたので、残りはそのプロセスに任せる
+                        print("\033[31mStopped shard %d %02d after losing its lease\033[0m"
+                              % (year, venue))
+                        self.discard_validators([item[0]])
+                        return
+                    yield item
+            except FetchError:
+                # 借りたままにせず、すぐに他のプロセスが（max_attempts 回までは）取得し直せるようにする
+                jobs.release([(year, venue)])
+                raise
+            yield (year, venue), None
+
+        return self.run_shards(jobs.claim, discover, stats)
+
+    def refresh_races(self, race_ids, stats=None):
+        # 保存済みのレースを (年, 開催場所) ごとにスレッドで再検証し、内容が変わったページだけを返す
+        shards = {}
+        for race_id in sorted(race_ids):
+            shards.setdefault(race_id[:6], []).append(race_id)
+
+        def discover(race_ids, shard_stats):
+            shard_stats["checked"] = shard_stats["changed"] = 0
+            for race_id in race_ids:
+                shard_stats["checked"] += 1
+                content = self.revalidate(race_id)
+                if content is not None:
+                    shard_stats["changed"] += 1
+                    yield race_id, content
+
+        return self.run_shards(get_next_shard((race_ids,) for race_ids in shards.values()),
+                               discover, stats)
+
+    def run_shards(self, next_shard, discover, stats=None):
+        # max_in_flight 個のスレッドがそれぞれ next_shard() でシャードを取り出し、None になるまで探索する
+        if stats is None:
+            stats = {}
+        results = queue.Queue(maxsize=self.max_in_flight * 2)
+        stop = threading.Event()
+
+        def stopped():
+            # 呼び出し側が例外で抜けた場合もスレッドを止める
+            return stop.is_set() or not threading.main_thread().is_alive()
+
+        def put(item):
+            while not stopped():
+                try:
+                    results.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def worker():
+            self.local.stopped = stopped
+            try:
+                while not stopped():
+                    shard = next_shard()
+                    if shard is None:
+                        break
+                    shard_stats = {}
+                    try:
+                        for item in discover(*shard, shard_stats):
+                            if stopped():
+                                return
+                            put(item)
+                    except FetchError as exception:
+                        # 取得できなかったレース以降は次に実行したときに探索し直す
+                        shard_stats["failed_shards"] = 1
+                        print("\033[31mGave up on shard %s: %s\033[0m" % (shard, exception))
+                    put((None, shard_stats))
+            except Stopped:
+                pass
+            except Exception as exception:
+                put((None, exception))
+            finally:
+                put((None, None))
+
+        executor = ThreadPoolExecutor(max_workers=self.max_in_flight)
+        try:
+            for _ in range(self.max_in_flight):
+                executor.submit(worker)
+            remaining = self.max_in_flight
+            while remaining:
+                race_id, result = results.get()
+                if race_id is not None:
+                    yield race_id, result
+                    continue
+                if result is None:
+                    remaining -= 1
+                    continue
+                if isinstance(result, Exception):
+                    raise result
+                for key, value in result.items():
+                    stats[key] = stats.get(key, 0) + value
+        finally:
+            stop.set()
+            executor.shutdown(wait=True, cancel_futures=True)
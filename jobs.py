@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import socket
+import sqlite3
+import threading
+import time
+import metrics
+
+def connect(path):
+    # 複数のマシンから共有のファイルシステム越しに使うので、共有メモリが必要な WAL は使わない
+    connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=DELETE")
+    return connection
+
+class LeaseLost(Exception):
+    def __init__(self, shard):
+        super().__init__("Lost lease on %d %02d" % tuple(shard))
+        self.shard = shard
+
+class JobQueue:
+    # (年, 開催場所) のシャードを複数のプロセス・マシンで分担するためのジョブテーブル
+    # claim したシャードは lease_seconds 秒の期限付きで借り、借りている間は heartbeat で延長する
+    # 期限が切れたシャード（プロセスが落ちたもの）は他のプロセスが claim し直す
+    def __init__(self, path, lease_seconds=300, max_attempts=3, owner=None):
+        self.connection = connect(path)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS job (
+                year        INTEGER,
+                venue       INTEGER,
+                status      TEXT,
+                owner       TEXT,
+                lease_until REAL,
+                attempts    INTEGER,
+                updated_at  REAL,
+                PRIMARY KEY (year, venue)
+            )
+        """)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.owner = owner or "%s:%d" % (socket.gethostname(), os.getpid())
+        self.lock = threading.Lock()
+        self.held = set()
+        self.stop = threading.Event()
+        threading.Thread(target=self.heartbeat_loop, daemon=True).start()
+
+    def transaction(self, statements):
+        # statements は cursor を受け取り、結果を返す関数
+        with self.lock:
+            cursor = self.connection.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                result = statements(cursor)
+                cursor.execute("COMMIT")
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+        return result
+
+    def add(self, shards):
+        # 既にあるシャードはそのまま（完了済みのものも含む）
+        now = time.time()
+        self.transaction(lambda cursor: cursor.executemany(
+            "INSERT OR IGNORE INTO job VALUES (?, ?, 'pending', NULL, 0, 0, ?)",
+            [(year, venue, now) for year, venue in shards]))
+
+    def claim(self):
+        def statements(cursor):
+            now = time.time()
+            cursor.execute("""
+                UPDATE job SET status = 'failed', updated_at = ?
+                WHERE status = 'running' AND lease_until < ? AND attempts >= ?
+            """, [now, now, self.max_attempts])
+            cursor.execute("""
+                SELECT year, venue FROM job
+                WHERE status = 'pending' OR (status = 'running' AND lease_until < ?)
+                ORDER BY year, venue LIMIT 1
+            """, [now])
+            row = cursor.fetchone()
+            if row is not None:
+                cursor.execute("""
+                    UPDATE job SET status = 'running', owner = ?, lease_until = ?,
+                                   attempts = attempts + 1, updated_at = ?
+                    WHERE year = ? AND venue = ?
+                """, [self.owner, now + self.lease_seconds, now, row[0], row[1]])
+            return row
+
+        if self.stop.is_set():
+            return None
+        shard = self.transaction(statements)
+        if shard is None:
+            return None
+        self.held.add(shard)
+        metrics.inc("jobs_claimed_total")
+        return shard
+
+    def heartbeat(self):
+        def statements(cursor):
+            now = time.time()
+            lost = []
+            for year, venue in list(self.held):
+                cursor.execute("""
+                    UPDATE job SET lease_until = ?, updated_at = ?
+                    WHERE year = ? AND venue = ? AND owner = ? AND status = 'running'
+                """, [now + self.lease_seconds, now, year, venue, self.owner])
+                if cursor.rowcount == 0:
+                    lost.append((year, venue))
+            return lost
+
+        for shard in self.transaction(statements):
+            # 期限切れの間に他のプロセスに取られた
+            self.held.discard(shard)
+            metrics.inc("leases_lost_total")
+            print("\033[31mLost lease on %d %02d\033[0m" % shard)
+
+    def heartbeat_loop(self):
+        while not self.stop.wait(self.lease_seconds / 3):
+            if self.held:
+                self.heartbeat()
+
+    def complete(self, shard):
+        # 他のプロセスに取られていたら LeaseLost にする
+        year, venue = shard
+        rowcount = self.transaction(lambda cursor: cursor.execute("""
+            UPDATE job SET status = 'done', updated_at = ?
+            WHERE year = ? AND venue = ? AND owner = ?
+        """, [time.time(), year, venue, self.owner]).rowcount)
+        self.held.discard(shard)
+        if rowcount == 0:
+            metrics.inc("leases_lost_total")
+            raise LeaseLost(shard)
+        metrics.inc("jobs_completed_total")
+
+    def release(self, shards=None):
+        # 取得できなかったシャードや、途中で終了するときに借りているシャードを他のプロセスに返す
+        # max_attempts 回借りても終わらなかったシャードは返さずに failed にする
+        shards = list(self.held if shards is None else shards)
+
+        def statements(cursor):
+            now = time.time()
+            for year, venue in shards:
+                cursor.execute("""
+                    UPDATE job SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+                                   owner = NULL, updated_at = ?
+                    WHERE year = ? AND venue = ? AND owner = ? AND status = 'running'
+                """, [self.max_attempts, now, year, venue, self.owner])
+
+        if shards:
+            self.transaction(statements)
+            self.held.difference_update(shards)
+
+    def counts(self):
+        with self.lock:
+            return dict(self.connection.execute("SELECT status, COUNT(*) FROM job GROUP BY status"))
+
+    def close(self):
+        self.stop.set()
+        self.release()
+        self.connection.close()
+
+class SharedRateLimiter:
+    # RateLimiter と同じトークンバケットを sqlite のファイルに置き、複数のプロセスで共有する
+    # rate も同じ行に置き、どのプロセスの AimdController が調整しても全体の rate が変わる
+    def __init__(self, path, rate, burst=1):
+        self.connection = connect(path)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS rate_limit (
+                id        INTEGER PRIMARY KEY CHECK (id = 0),
+                tokens    REAL,
+                timestamp REAL,
+                rate      REAL
+            )
+        """)
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(rate_limit)")]
+        if "rate" not in columns:
+            self.connection.execute("ALTER TABLE rate_limit ADD COLUMN rate REAL")
+        # 既に他のプロセスが使っている場合は、その rate を引き継ぐ
+        self.connection.execute("INSERT OR IGNORE INTO rate_limit VALUES (0, ?, ?, ?)",
+                                [burst, time.time(), rate])
+        self.connection.execute("UPDATE rate_limit SET rate = ? WHERE id = 0 AND rate IS NULL", [rate])
+        self.burst = burst
+        self.lock = threading.Lock()
+
+    def transaction(self, statements):
+        # statements は cursor を受け取り、結果を返す関数
+        with self.lock:
+            cursor = self.connection.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                result = statements(cursor)
+                cursor.execute("COMMIT")
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+        return result
+
+    def acquire(self):
+        def statements(cursor):
+            tokens, timestamp, rate = cursor.execute(
+                "SELECT tokens, timestamp, rate FROM rate_limit WHERE id = 0").fetchone()
+            now = time.time()
+            tokens = min(self.burst, tokens + max(now - timestamp, 0) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            if tokens >= 1:
+                tokens -= 1
+            cursor.execute("UPDATE rate_limit SET tokens = ?, timestamp = ? WHERE id = 0",
+                           [tokens, now])
+            return wait
+
+        while True:
+            wait = self.transaction(statements)
+            if wait == 0:
+                return
+            time.sleep(wait)
+
+    @property
+    def rate(self):
+        with self.lock:
+            return self.connection.execute("SELECT rate FROM rate_limit WHERE id = 0").fetchone()[0]
+
+    def update_rate(self, update):
+        # update は今の rate を受け取り、新しい rate を返す関数
+        def statements(cursor):
+            rate = update(cursor.execute("SELECT rate FROM rate_limit WHERE id = 0").fetchone()[0])
+            cursor.execute("UPDATE rate_limit SET rate = ? WHERE id = 0", [rate])
+            return rate
+
+        return self.transaction(statements)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import bisect
+import json
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PREFIX = "netkeiba_"
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+lock = threading.Lock()
+counters = {}
+histograms = {}
+
+def get_key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+def inc(name, value=1, **labels):
+    key = get_key(name, labels)
+    with lock:
+        counters[key] = counters.get(key, 0) + value
+
+def observe(name, value, **labels):
+    key = get_key(name, labels)
+    index = bisect.bisect_left(BUCKETS, value)
+    with lock:
+        histogram = histograms.get(key)
+        if histogram is None:
+            # 各バケットの件数 + 合計 + 件数
+            histogram = histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0, 0]
+        histogram[index] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+@contextmanager
+def timer(stage):
+    time_start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe("stage_seconds", time.perf_counter() - time_start, stage=stage)
+
+def reset():
+    # fork したワーカープロセスが親の値や lock の状態を引き継がないようにする
+    global lock, counters, histograms
+    lock = threading.Lock()
+    counters = {}
+    histograms = {}
+
+def drain():
+    # 子プロセスで記録した値を取り出して親プロセスに渡す
+    global counters, histograms
+    with lock:
+        snapshot = (counters, histograms)
+        counters = {}
+        histograms = {}
+    return snapshot
+
+def merge(snapshot):
+    other_counters, other_histograms = snapshot
+    with lock:
+        for key, value in other_counters.items():
+            counters[key] = counters.get(key, 0) + value
+        for key, other in other_histograms.items():
+            histogram = histograms.setdefault(key, [0] * (len(BUCKETS) + 1) + [0.0, 0])
+            for i, value in enumerate(other):
+                histogram[i] += value
+
+def format_labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (key, value) for key, value in labels)
+
+def render():
+    with lock:
+        counter_items = sorted(counters.items())
+        histogram_items = sorted((key, list(value)) for key, value in histograms.items())
+    lines = []
+    for (name, labels), value in counter_items:
+        lines.append("%s%s%s %s" % (PREFIX, name, format_labels(labels), value))
+    for (name, labels), histogram in histogram_items:
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ("+Inf",), histogram):
+            cumulative += count
+            lines.append("%s%s_bucket%s %d" % (PREFIX, name, format_labels(labels, [("le", bound)]),
+                                              cumulative))
+        lines.append("%s%s_sum%s %f" % (PREFIX, name, format_labels(labels), histogram[-2]))
+        lines.append("%s%s_count%s %d" % (PREFIX, name, format_labels(labels), histogram[-1]))
+    return "\n".join(lines) + "\n"
+
+def to_dict():
+    with lock:
+        return {
+            "time": time.time(),
+            "counters": [{"name": name, "labels": dict(labels), "value": value}
+                         for (name, labels), value in sorted(counters.items())],
+            "histograms": [{"name": name, "labels": dict(labels), "buckets": list(BUCKETS),
+                            "counts": value[:-2], "sum": value[-2], "count": value[-1]}
+                           for (name, labels), value in sorted(histograms.items())],
+        }
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip("/") != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(port):
+    server = ThreadingHTTPServer(("", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def dump_json(path):
+    with open(path, "w") as f:
+        json.dump(to_dict(), f, ensure_ascii=False, indent=2)
+
+def dump_periodically(path, interval=60):
+    def loop():
+        while True:
+            time.sleep(interval)
+            dump_json(path)
+    threading.Thread(target=loop, daemon=True).start()
+
+def start(port=None, json_path=None, interval=60):
+    if port:
+        serve(port)
+    if json_path:
+        dump_periodically(json_path, interval)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+import metrics
+import scraper
+
+# ProcessPoolExecutor のワーカープロセスかどうか
+in_worker = False
+
+def init_worker():
+    # fork したワーカープロセスでは親から引き継いだ値を捨て、記録した値は結果と一緒に親に返す
+    global in_worker
+    in_worker = True
+    metrics.reset()
+
+def get_snapshot():
+    # 親プロセスで parse_race を呼んだ場合は、記録した値が既に集計に入っているので何も返さない
+    # ここで drain すると、/metrics が merge までの間に fetcher のスレッドのカウンタも減って見える
+    return metrics.drain() if in_worker else ({}, {})
+
+def parse_race(race_id, content):
+    soup = scraper.parse_html(content)
+    if soup is None:
+        return race_id, None, get_snapshot()
+    try:
+        result = scraper.collect_data(soup, race_id)
+    except scraper.ParseError as exception:
+        print("\033[31m")
+        print("Could not parse race_id %s" % race_id)
+        print(exception)
+        print("\033[0m")
+        metrics.inc("parse_errors_total")
+        result = None
+    return race_id, result, get_snapshot()
+
+def get_result(race_id, result, snapshot):
+    # ワーカープロセスで計測した値をこのプロセスの集計に加える
+    metrics.merge(snapshot)
+    return race_id, result
+
+def get_passed(race_id):
+    future = Future()
+    future.set_result((race_id, None, ({}, {})))
+    return future
+
+def parse_races(races, workers=None, max_pending=None):
+    # (race_id, html) を受け取り、パースした結果を受け取った順に返す
+    # 結果待ちは max_pending 件までなので、それ以上は races から読み進めない
+    # html が None のものはパースせず、順番を保ったまま (race_id, None) を返す
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers == 0:
+        for race_id, content in races:
+            if content is None:
+                yield race_id, None
+                continue
+            yield get_result(*parse_race(race_id, content))
+        return
+    if max_pending is None:
+        max_pending = workers * 4
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+        pending = deque()
+        for race_id, content in races:
+            if content is None:
+                pending.append(get_passed(race_id))
+            else:
+                pending.append(executor.submit(parse_race, race_id, content))
+            if len(pending) >= max_pending:
+                yield get_result(*pending.popleft().result())
+        while pending:
+            yield get_result(*pending.popleft().result())
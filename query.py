@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import datetime
+import sqlite3
+import numpy as np
+
+# 列名 -> NumPy の型（ここにない列は horse_id なども含めて文字列として object 型）
+# NULL になりうる数値の列は float にして NaN で表す
+COLUMN_DTYPES = {
+    "rowid":             "int64",
+    "race_id":           "int64",
+    "year":              "int16",
+    "month":             "int8",
+    "day":               "int8",
+    "date":              "datetime64[D]",
+    "race_number":       "int8",
+    "course_distance":   "int16",
+    "jockey_key":        "int64",
+    "trainer_key":       "int64",
+    "rank":              "float32",
+    "slot":              "int8",
+    "horse_num":         "int8",
+    "horse_age":         "int8",
+    "jockey_weight":     "float32",
+    "goal_time":         "float32",
+    "last_time":         "float32",
+    "odds":              "float32",
+    "popularity":        "float32",
+    "horse_weight":      "float32",
+    "horse_weight_diff": "float32",
+    "prize":             "float32",
+    "odds_place":        "float32",
+}
+
+DATE = "printf('%04d-%02d-%02d', i.year, i.month, i.day) AS date"
+
+def to_columns(cursor):
+    # カーソルの結果を {列名: NumPy 配列} にする
+    names = [description[0] for description in cursor.description]
+    rows = cursor.fetchall()
+    columns = zip(*rows) if rows else [()] * len(names)
+    result = {}
+    for name, values in zip(names, columns):
+        dtype = np.dtype(COLUMN_DTYPES.get(name, object))
+        if dtype.kind == "f":
+            # NULL や古いデータに残っている文字列は NaN にする
+            values = [value if isinstance(value, (int, float)) else np.nan for value in values]
+        result[name] = np.array(values, dtype=dtype)
+    return result
+
+class RaceDatabase:
+    # scraping_sqlite.py で作ったデータベースを読む
+    def __init__(self, dbpath):
+        self.connection = sqlite3.connect(dbpath)
+
+    def horse_history(self, horse_id):
+        # 馬の出走履歴を日付順に返す
+        cursor = self.connection.execute("""
+            SELECT %s, i.venue, i.race_name, i.course_type, i.course_distance, i.course_state, d.*
+            FROM race_data d JOIN race_info i ON i.race_id = d.race_id
+            WHERE d.horse_id = ?
+            ORDER BY i.year, i.month, i.day, d.race_id
+        """ % DATE, [str(horse_id)])
+        return to_columns(cursor)
+
+    def races_on(self, date):
+        # その日に行われたレースを開催場所・レース番号順に返す
+        if isinstance(date, str):
+            date = datetime.date.fromisoformat(date)
+        cursor = self.connection.execute("""
+            SELECT %s, i.* FROM race_info i
+            WHERE i.year = ? AND i.month = ? AND i.day = ?
+            ORDER BY i.venue, i.race_number
+        """ % DATE, [date.year, date.month, date.day])
+        return to_columns(cursor)
+
+    def field(self, race_id):
+        # レースの出走馬を馬番順に返す
+        cursor = self.connection.execute("""
+            SELECT * FROM race_data WHERE race_id = ? ORDER BY horse_num
+        """, [int(race_id)])
+        return to_columns(cursor)
+
+    def close(self):
+        self.connection.close()
@@ -1,10 +1,33 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+import hashlib
 import re
-import requests
-import pandas as pd
-from bs4 import BeautifulSoup
+from collections import namedtuple
+from itertools import zip_longest
+from bs4 import BeautifulSoup, SoupStrainer
+import metrics
+
+try:
+    import lxml # noqa: F401
+    PARSER = "lxml"
+except ImportError:
+    PARSER = "html.parser"
+
+URL_BASE = "https://db.netkeiba.com/race/"
+HORSE_URL_BASE = "https://db.netkeiba.com/horse/"
+
+# collect_data が参照する部分だけを木として組み立てる
+PARSE_REGIONS = SoupStrainer(["div", "table"],
+                             attrs={"class": re.compile(r"data_intro|race_table_01|pay_table_01")})
+
+# 内容が変わったかどうかは collect_data が参照する部分だけで判断し、広告などが変わっても無視する
+DIGEST_REGIONS = re.compile(rb'<dl class="racedata.*?</dl>|<p class="smalltxt">.*?</p>'
+                            rb'|<table class="(?:race_table_01|pay_table_01)[^"]*".*?</table>', re.S)
+
+# 馬のページのうち get_horse_profile が参照する部分
+HORSE_PARSE_REGIONS = SoupStrainer(["div", "table"],
+                                   attrs={"class": re.compile(r"horse_title|db_prof_table|blood_table")})
 
 RACE_INFO_COLUMNS = [
     "race_id",          # レースID
@@ -67,39 +90,235 @@ RACE_DATA_COLUMNS = [
     "horse_weight_diff", # 馬体重の増減
     "trainer",           # 調教師
     "prize",             # 獲得賞金
-    "odds_place"         # 複勝のオッズ
+    "odds_place",        # 複勝のオッズ
+    "jockey_id",         # 騎手ID
+    "trainer_id",        # 調教師ID
 ]
 
-def get_race_ids(start_year, end_year):
-    years = list(range(start_year, end_year + 1))
-    venues = list(range(1, 11))
-    numbers = list(range(1, 11))
-    days = list(range(1, 11))
-    races = list(range(1, 13))
-
-    race_ids = [f"{y}{v:02}{n:02}{d:02}{r:02}" \
-                for y in years \
-                for v in venues \
-                for n in numbers \
-                for d in days \
-                for r in races]
-
-    return sorted(race_ids)
-
-def get_html(race_id):
-    url_base = "https://db.netkeiba.com/race/"
-    url = url_base + str(race_id)
-    html = requests.get(url)
-    html.encoding = "EUC-JP"
-    soup = BeautifulSoup(html.text, "html.parser")
+PAYOUT_COLUMNS = [
+    "race_id",           # レースID
+    "bet_type",          # 券種（win, place, ... RACE_REFUND_COLUMNS の接頭辞と同じ）
+    "combination",       # 馬番（枠連は枠番）を2桁ずつ詰めた整数 例: 1 - 2 - 3 -> 10203
+    "payout",            # 100円あたりの払戻金
+    "popularity",        # 人気
+]
+
+HORSE_COLUMNS = [
+    "horse_id",          # 馬ID
+    "horse_name",        # 馬名
+    "active",            # 現役なら 1、抹消なら 0
+    "horse_gender",      # 性別
+    "coat_color",        # 毛色
+    "birth_date",        # 生年月日 (yyyy-mm-dd)
+    "trainer_id",        # 調教師ID
+    "owner_id",          # 馬主ID
+    "owner",             # 馬主
+    "breeder_id",        # 生産者ID
+    "breeder",           # 生産者
+    "birthplace",        # 産地
+    "sire_id",           # 父
+    "sire",
+    "dam_id",            # 母
+    "dam",
+    "broodmare_sire_id", # 母父
+    "broodmare_sire",
+]
+
+# 払い戻しの表の th の class -> 券種
+PAYOUT_BET_TYPES = {
+    "tan":     "win",
+    "fuku":    "place",
+    "waku":    "bracket_quinella",
+    "uren":    "quinella",
+    "wide":    "quinella_place",
+    "utan":    "exacta",
+    "sanfuku": "trio",
+    "santan":  "tierce",
+}
+
+# カテゴリとして扱う列の取りうる値
+VENUE_NAMES = ["札幌", "函館", "福島", "新潟", "東京", "中山", "中京", "京都", "阪神", "小倉"]
+COURSE_TYPES = ["芝", "ダ", "芝ダ"]
+COURSE_DIRECTIONS = ["左", "右", "障", "直"]
+WEATHERS = ["晴", "曇", "小雨", "雨", "小雪", "雪"]
+COURSE_STATES = ["良", "稍重", "重", "不良"]
+COURSE_STATES += [turf + "/" + dirt for turf in COURSE_STATES for dirt in COURSE_STATES]
+HORSE_GENDERS = ["牡", "牝", "セ"]
+
+# DataFrame に変換するときの型
+RACE_INFO_DTYPES = {
+    "race_id":          "int64",
+    "year":             "int16",
+    "month":            "int8",
+    "day":              "int8",
+    "venue":            VENUE_NAMES,
+    "race_number":      "int8",
+    "course_type":      COURSE_TYPES,
+    "course_direction": COURSE_DIRECTIONS,
+    "course_distance":  "int16",
+    "weather":          WEATHERS,
+    "course_state":     COURSE_STATES,
+}
+
+RACE_DATA_DTYPES = {
+    "race_id":           "int64",
+    "rank":              "int8",
+    "slot":              "int8",
+    "horse_num":         "int8",
+    "horse_gender":      HORSE_GENDERS,
+    "horse_age":         "int8",
+    "jockey_weight":     "float32",
+    "goal_time":         "float32",
+    "last_time":         "float32",
+    "odds":              "float32",
+    "popularity":        "Int8",
+    "horse_weight":      "Int16",
+    "horse_weight_diff": "Int16",
+    "prize":             "float32",
+    "odds_place":        "float32",
+}
+
+PAYOUT_DTYPES = {
+    "race_id":     "int64",
+    "bet_type":    list(PAYOUT_BET_TYPES.values()),
+    "combination": "int32",
+    "payout":      "int32",
+    "popularity":  "Int16",
+}
+
+class ParseError(Exception):
+    def __init__(self, race_id, column, value):
+        super().__init__("race_id %s: could not parse %s from %r" % (race_id, column, value))
+        self.race_id = race_id
+        self.column = column
+        self.value = value
+
+RaceInfo = namedtuple("RaceInfo", RACE_INFO_COLUMNS + RACE_REFUND_COLUMNS)
+RaceRecord = namedtuple("RaceRecord", RACE_DATA_COLUMNS)
+Payout = namedtuple("Payout", PAYOUT_COLUMNS)
+HorseProfile = namedtuple("HorseProfile", HORSE_COLUMNS)
+
+def discover_venue_races(year, venue, fetch, exist_race_ids=(), stats=None):
+    # race_id = 年(4) + 開催場所(2) + 回(2) + 日目(2) + レース(2)
+    # 回・日目・レースはいずれも 01 から連番で振られるので、
+    # 01 が存在しなければその先は存在しないとみなして探索を打ち切る
+    if stats is None:
+        stats = {}
+    for key in ("candidates", "probed", "skipped"):
+        stats.setdefault(key, 0)
+    stats["candidates"] += 10 * 10 * 12
+
+    for n in range(1, 11):
+        for d in range(1, 11):
+            for r in range(1, 13):
+                race_id = f"{year}{venue:02}{n:02}{d:02}{r:02}"
+                if race_id in exist_race_ids:
+                    continue
+                stats["probed"] += 1
+                result = fetch(race_id)
+                if result is not None:
+                    yield race_id, result
+                elif r == 1:
+                    # 1レース目が無い日はそれ以降のレースも無い
+                    stats["skipped"] += 12 - r
+                    if d == 1:
+                        # 1日目が無い回はそれ以降の日目・回も無い
+                        stats["skipped"] += (10 - d) * 12 + (10 - n) * 10 * 12
+                        return
+                    break
+
+def get_latest_race_ids(race_ids):
+    # 開催場所ごとに最も新しい race_id を返す
+    latest_race_ids = {}
+    for race_id in race_ids:
+        race_id = str(race_id)
+        venue = int(race_id[4:6])
+        if race_id > latest_race_ids.get(venue, ""):
+            latest_race_ids[venue] = race_id
+    return latest_race_ids
+
+def get_next_race_ids(venue, race_id, start_year, end_year):
+    # race_id の次に開催されうるレースの候補を近い順に返す
+    # 同じ日の次のレース、次の日目の1レース目、次の回の1日目、以降の年の1回1日目
+    # race_id が None なら start_year からの各年の1回1日目
+    candidates = []
+    next_year = start_year
+    if race_id is not None:
+        y, n, d, r = int(race_id[:4]), int(race_id[6:8]), int(race_id[8:10]), int(race_id[10:12])
+        if r < 12:
+            candidates.append((y, n, d, r + 1))
+        if d < 10:
+            candidates.append((y, n, d + 1, 1))
+        if n < 10:
+            candidates.append((y, n + 1, 1, 1))
+        next_year = y + 1
+    candidates += [(y, 1, 1, 1) for y in range(next_year, end_year + 1)]
+    return [f"{y}{venue:02}{n:02}{d:02}{r:02}" for y, n, d, r in candidates]
+
+def discover_venue_races_after(venue, race_id, fetch, start_year, end_year, stats=None):
+    # 保存済みの最新のレース race_id の次から順に探索し、候補がどれも存在しなければ打ち切る
+    if stats is None:
+        stats = {}
+    for key in ("candidates", "probed", "skipped"):
+        stats.setdefault(key, 0)
+
+    while True:
+        for next_race_id in get_next_race_ids(venue, race_id, start_year, end_year):
+            stats["candidates"] += 1
+            stats["probed"] += 1
+            result = fetch(next_race_id)
+            if result is not None:
+                yield next_race_id, result
+                race_id = next_race_id
+                break
+        else:
+            return
+
+def has_race_table(content):
+    return b"race_table_01 nk_tb_common" in content
+
+def get_digest(content):
+    # DIGEST_REGIONS が見つからないページは全体のハッシュにする
+    regions = DIGEST_REGIONS.findall(content)
+    return hashlib.sha1(b"".join(regions) if regions else content).hexdigest()
+
+def parse_html(content, parser=None, parse_only=PARSE_REGIONS):
+    if not has_race_table(content):
+        return None
+    with metrics.timer("decode"):
+        text = content.decode("EUC-JP", errors="replace")
+    with metrics.timer("parse"):
+        soup = BeautifulSoup(text, parser or PARSER, parse_only=parse_only)
     if soup.find_all("table", "race_table_01 nk_tb_common") == []:
         return None
     return soup
 
+def to_int(value, column, race_id, nullable=False):
+    if value == "" and nullable:
+        return None
+    try:
+        return int(value.replace(",", ""))
+    except ValueError:
+        raise ParseError(race_id, column, value) from None
+
+def to_float(value, column, race_id, nullable=False):
+    if value == "" and nullable:
+        return None
+    try:
+        return float(value.replace(",", ""))
+    except ValueError:
+        raise ParseError(race_id, column, value) from None
+
+def to_category(value, categories, column, race_id):
+    if value not in categories:
+        raise ParseError(race_id, column, value)
+    return value
+
 def get_race_info(soup, race_id):
-    race_date = soup.find("div", "data_intro").find("p", "smalltxt").get_text(strip=True)
-    race_date = re.match(r"(\d+)年(\d+)月(\d+)日.+", race_date)
-    venue_names = [None, "札幌", "函館", "福島", "新潟", "東京", "中山", "中京", "京都", "阪神", "小倉"]
+    date_text = soup.find("div", "data_intro").find("p", "smalltxt").get_text(strip=True)
+    race_date = re.match(r"(\d+)年(\d+)月(\d+)日.+", date_text)
+    if race_date is None:
+        raise ParseError(race_id, "date", date_text)
     conditions = soup.find("dl", "racedata fc").find("span")\
                  .get_text(strip=True).replace("\xa0", "").split("/")
     course_type = ""
@@ -107,6 +326,7 @@ def get_race_info(soup, race_id):
         course_type += "芝"
     if "ダ" in conditions[0]:
         course_type += "ダ"
+    course_direction = None
     if "左" in conditions[0]:
         course_direction = "左"
     elif "右" in conditions[0]:
@@ -120,20 +340,24 @@ def get_race_info(soup, race_id):
         course_state = states.group(1) + "/" + states.group(2)
     else:
         course_state = conditions[2].split(" : ")[1]
+    course_distance = re.match(r".+([0-9]{4})m", conditions[0])
+    if course_distance is None:
+        raise ParseError(race_id, "course_distance", conditions[0])
 
     race_info = {
-        "race_id":          [race_id],
-        "year":             [race_date.group(1)],
-        "month":            [race_date.group(2)],
-        "day":              [race_date.group(3)],
-        "venue":            [venue_names[int(race_id[4:6])]],
-        "race_number":      [race_id[10:]],
-        "race_name":        [soup.find("dl", "racedata fc").find("h1").get_text(strip=True)],
-        "course_type":      [course_type],
-        "course_direction": [course_direction],
-        "course_distance":  [re.match(r".+([0-9]{4})m", conditions[0]).group(1)],
-        "weather":          [conditions[1].split(" : ")[1]],
-        "course_state":     [course_state]
+        "race_id":          int(race_id),
+        "year":             int(race_date.group(1)),
+        "month":            int(race_date.group(2)),
+        "day":              int(race_date.group(3)),
+        "venue":            VENUE_NAMES[int(race_id[4:6]) - 1],
+        "race_number":      int(race_id[10:]),
+        "race_name":        soup.find("dl", "racedata fc").find("h1").get_text(strip=True),
+        "course_type":      to_category(course_type, COURSE_TYPES, "course_type", race_id),
+        "course_direction": to_category(course_direction, COURSE_DIRECTIONS,
+                                        "course_direction", race_id),
+        "course_distance":  int(course_distance.group(1)),
+        "weather":          to_category(conditions[1].split(" : ")[1], WEATHERS, "weather", race_id),
+        "course_state":     to_category(course_state, COURSE_STATES, "course_state", race_id)
     }
     return race_info
 
@@ -143,120 +367,269 @@ def get_refunds(tables):
     win = tables[0].find("th", "tan") # 単勝
     if win is not None:
         td = win.parent.find_all("td")
-        refunds["win_number"] = [td[0].get_text(" ")]
-        refunds["win_refund"] = [td[1].get_text(" ")]
-        refunds["win_population"] = [td[2].get_text(" ")]
-    place = tables[0].find("th", "fuku".startswith("fuku"))  # 複勝
+        refunds["win_number"] = td[0].get_text(" ")
+        refunds["win_refund"] = td[1].get_text(" ")
+        refunds["win_population"] = td[2].get_text(" ")
+    place = tables[0].find("th", "fuku")  # 複勝
     if place is not None:
         td = place.parent.find_all("td")
-        refunds["place_number"] = [td[0].get_text(" ")]
-        refunds["place_refund"] = [td[1].get_text(" ")]
-        refunds["place_population"] = [td[2].get_text(" ")]
+        refunds["place_number"] = td[0].get_text(" ")
+        refunds["place_refund"] = td[1].get_text(" ")
+        refunds["place_population"] = td[2].get_text(" ")
     bracket_quinella = tables[0].find("th", "waku")  # 枠連
     if bracket_quinella is not None:
         td = bracket_quinella.parent.find_all("td")
-        refunds["bracket_quinella_number"] = [td[0].get_text(" ")]
-        refunds["bracket_quinella_refund"] = [td[1].get_text(" ")]
-        refunds["bracket_quinella_population"] = [td[2].get_text(" ")]
+        refunds["bracket_quinella_number"] = td[0].get_text(" ")
+        refunds["bracket_quinella_refund"] = td[1].get_text(" ")
+        refunds["bracket_quinella_population"] = td[2].get_text(" ")
     quinella = tables[0].find("th", "uren")  # 馬連
     if quinella is not None:
         td = quinella.parent.find_all("td")
-        refunds["quinella_number"] = [td[0].get_text(" ")]
-        refunds["quinella_refund"] = [td[1].get_text(" ")]
-        refunds["quinella_population"] = [td[2].get_text(" ")]
+        refunds["quinella_number"] = td[0].get_text(" ")
+        refunds["quinella_refund"] = td[1].get_text(" ")
+        refunds["quinella_population"] = td[2].get_text(" ")
     quinella_place = tables[1].find("th", "wide")  # ワイド
     if quinella_place is not None:
         td = quinella_place.parent.find_all("td")
-        refunds["quinella_place_number"] = [td[0].get_text(" ")]
-        refunds["quinella_place_refund"] = [td[1].get_text(" ")]
-        refunds["quinella_place_population"] = [td[2].get_text(" ")]
+        refunds["quinella_place_number"] = td[0].get_text(" ")
+        refunds["quinella_place_refund"] = td[1].get_text(" ")
+        refunds["quinella_place_population"] = td[2].get_text(" ")
     exacta = tables[1].find("th", "utan") # 馬単
     if exacta is not None:
         td = exacta.parent.find_all("td")
-        refunds["exacta_number"] = [td[0].get_text(" ")]
-        refunds["exacta_refund"] = [td[1].get_text(" ")]
-        refunds["exacta_population"] = [td[2].get_text(" ")]
+        refunds["exacta_number"] = td[0].get_text(" ")
+        refunds["exacta_refund"] = td[1].get_text(" ")
+        refunds["exacta_population"] = td[2].get_text(" ")
     trio = tables[1].find("th", "sanfuku") # 三連複
     if trio is not None:
         td = trio.parent.find_all("td")
-        refunds["trio_number"] = [td[0].get_text(" ")]
-        refunds["trio_refund"] = [td[1].get_text(" ")]
-        refunds["trio_population"] = [td[2].get_text(" ")]
+        refunds["trio_number"] = td[0].get_text(" ")
+        refunds["trio_refund"] = td[1].get_text(" ")
+        refunds["trio_population"] = td[2].get_text(" ")
     tierce = tables[1].find("th", "santan") # 三連単
     if tierce is not None:
         td = tierce.parent.find_all("td")
-        refunds["tierce_number"] = [td[0].get_text(" ")]
-        refunds["tierce_refund"] = [td[1].get_text(" ")]
-        refunds["tierce_population"] = [td[2].get_text(" ")]
+        refunds["tierce_number"] = td[0].get_text(" ")
+        refunds["tierce_refund"] = td[1].get_text(" ")
+        refunds["tierce_population"] = td[2].get_text(" ")
 
     return refunds
 
-def get_race_records(table, race_refunds, race_id):
-    records = {column:[] for column in RACE_DATA_COLUMNS}
+def pack_combination(text):
+    # "1 - 2 - 3" や "1 → 2 → 3" を 10203 のように2桁ずつ詰めた整数にする
+    combination = 0
+    for number in re.findall(r"\d+", text):
+        combination = combination * 100 + int(number)
+    return combination
+
+def get_payouts(tables, race_id):
+    # 払い戻しを (券種, 組み合わせ) ごとに1行にする
+    payouts = []
+    for table in tables:
+        for th in table.find_all("th"):
+            bet_type = PAYOUT_BET_TYPES.get((th.get("class") or [""])[0])
+            if bet_type is None:
+                continue
+            td = th.parent.find_all("td")
+            # 同着や複勝・ワイドは <br /> 区切りで複数行ある
+            for combination, payout, popularity in zip_longest(
+                    td[0].stripped_strings, td[1].stripped_strings, td[2].stripped_strings,
+                    fillvalue=""):
+                payouts.append(Payout(
+                    race_id=int(race_id),
+                    bet_type=bet_type,
+                    combination=pack_combination(combination),
+                    payout=to_int(payout, "payout", race_id),
+                    popularity=to_int(popularity, "payout_popularity", race_id, True),
+                ))
+    return payouts
+
+def get_place_odds(payouts):
+    # 馬番 -> 複勝のオッズ
+    return {payout.combination: payout.payout / 100
+            for payout in payouts if payout.bet_type == "place"}
+
+def get_link_id(cell):
+    # <a href="/jockey/01088/"> -> "01088"
+    link = cell.find("a")
+    if link is None or not link.get("href"):
+        return None
+    return link.get("href").strip("/").split("/")[-1]
+
+def get_race_records(table, payouts, race_id):
+    records = []
+    place_odds = get_place_odds(payouts)
 
     for i in range(1, len(table)):
         row = table[i].find_all("td")
         rank = row[0].get_text(strip=True)
         if not rank.isdecimal():
             continue
-        horse_num = row[2].get_text(strip=True)
+        horse_num = to_int(row[2].get_text(strip=True), "horse_num", race_id)
         weight = re.match(r"(\d+)\((\D*\d+)\)", row[14].get_text(strip=True))
-        horse_weight = ""
-        horse_weight_diff = ""
+        horse_weight = None
+        horse_weight_diff = None
         if weight is not None:
-            horse_weight = weight.group(1)
-            horse_weight_diff = weight.group(2)
-
-        odds_place = None
-        place_numbers = race_refunds["place_number"][0].split(" ")
-        place_refunds = race_refunds["place_refund"][0].split(" ")
-        for i in range(len(place_numbers)):
-            if horse_num == place_numbers[i]:
-                odds_place = int(place_refunds[i].replace(",", "")) / 100
-
-        records["race_id"] += [race_id]
-        records["horse_id"] += [row[3].find("a").get("href").split("/")[2]]
-        records["rank"] += [rank]
-        records["slot"] += [row[1].get_text(strip=True)]
-        records["horse_num"] += [horse_num]
-        records["horse_name"] += [row[3].get_text(strip=True)]
-        records["horse_gender"] += [row[4].get_text(strip=True)[0]]
-        records["horse_age"] += [row[4].get_text(strip=True)[1:]]
-        records["jockey_weight"] += [row[5].get_text(strip=True)]
-        records["jockey_name"] += [row[6].get_text(strip=True)]
-        records["goal_time"] += [to_sec(row[7].get_text(strip=True))]
-        records["last_time"] += [row[11].get_text(strip=True)]
-        records["odds"] += [row[12].get_text(strip=True)]
-        records["popularity"] += [row[13].get_text(strip=True)]
-        records["horse_weight"] += [horse_weight]
-        records["horse_weight_diff"] += [horse_weight_diff]
-        records["trainer"] += [row[18].get_text(strip=True)]
-        records["prize"] += [row[20].get_text(strip=True)]
-        records["odds_place"] += [odds_place]
-    return pd.DataFrame.from_dict(records)
+            horse_weight = int(weight.group(1))
+            horse_weight_diff = to_int(weight.group(2), "horse_weight_diff", race_id)
+        horse = row[4].get_text(strip=True)
+        goal_time = row[7].get_text(strip=True)
+        if not re.fullmatch(r"\d+:\d+(\.\d+)?", goal_time):
+            raise ParseError(race_id, "goal_time", goal_time)
+
+        records.append(RaceRecord(
+            race_id=int(race_id),
+            horse_id=row[3].find("a").get("href").split("/")[2],
+            rank=int(rank),
+            slot=to_int(row[1].get_text(strip=True), "slot", race_id),
+            horse_num=horse_num,
+            horse_name=row[3].get_text(strip=True),
+            horse_gender=to_category(horse[:1], HORSE_GENDERS, "horse_gender", race_id),
+            horse_age=to_int(horse[1:], "horse_age", race_id),
+            jockey_weight=to_float(row[5].get_text(strip=True), "jockey_weight", race_id),
+            jockey_name=row[6].get_text(strip=True),
+            goal_time=to_sec(goal_time),
+            last_time=to_float(row[11].get_text(strip=True), "last_time", race_id, True),
+            odds=to_float(row[12].get_text(strip=True), "odds", race_id, True),
+            popularity=to_int(row[13].get_text(strip=True), "popularity", race_id, True),
+            horse_weight=horse_weight,
+            horse_weight_diff=horse_weight_diff,
+            trainer=row[18].get_text(strip=True),
+            prize=to_float(row[20].get_text(strip=True), "prize", race_id, True),
+            odds_place=place_odds.get(horse_num),
+            jockey_id=get_link_id(row[6]),
+            trainer_id=get_link_id(row[18]),
+        ))
+    return records
+
+def has_horse_profile(content):
+    return b"db_prof_table" in content
+
+def parse_horse_html(content, parser=None):
+    if not has_horse_profile(content):
+        return None
+    text = content.decode("EUC-JP", errors="replace")
+    soup = BeautifulSoup(text, parser or PARSER, parse_only=HORSE_PARSE_REGIONS)
+    if soup.find("table", "db_prof_table") is None:
+        return None
+    return soup
+
+def get_horse_profile(soup, horse_id):
+    title = soup.find("div", "horse_title")
+    # "現役　牡5歳　鹿毛" or "抹消　牝　栗毛"
+    status = title.find("p", "txt_01").get_text(strip=True).split() if title else []
+    status += [""] * (3 - len(status))
+    profile = {}
+    for row in soup.find("table", "db_prof_table").find_all("tr"):
+        th = row.find("th")
+        td = row.find("td")
+        if th is not None and td is not None:
+            profile[th.get_text(strip=True)] = td
+    birth_date = re.match(r"(\d+)年(\d+)月(\d+)日", get_cell_text(profile.get("生年月日")) or "")
+    if birth_date is not None:
+        birth_date = "%04d-%02d-%02d" % tuple(int(value) for value in birth_date.groups())
+    # 血統表のセルは 父、父父、父母、母、母父、母母 の順
+    blood = soup.find("table", "blood_table")
+    cells = blood.find_all("td") if blood is not None else []
+    cells += [None] * (6 - len(cells))
+
+    return HorseProfile(
+        horse_id=str(horse_id),
+        horse_name=title.find("h1").get_text(strip=True) if title and title.find("h1") else None,
+        active=int(status[0] == "現役"),
+        horse_gender=status[1][:1] if status[1][:1] in HORSE_GENDERS else None,
+        coat_color=status[2] or None,
+        birth_date=birth_date,
+        trainer_id=get_cell_link_id(profile.get("調教師")),
+        owner_id=get_cell_link_id(profile.get("馬主")),
+        owner=get_cell_text(profile.get("馬主")),
+        breeder_id=get_cell_link_id(profile.get("生産者")),
+        breeder=get_cell_text(profile.get("生産者")),
+        birthplace=get_cell_text(profile.get("産地")),
+        sire_id=get_cell_link_id(cells[0]),
+        sire=get_cell_text(cells[0]),
+        dam_id=get_cell_link_id(cells[3]),
+        dam=get_cell_text(cells[3]),
+        broodmare_sire_id=get_cell_link_id(cells[4]),
+        broodmare_sire=get_cell_text(cells[4]),
+    )
+
+def get_cell_text(cell):
+    if cell is None:
+        return None
+    # 血統表のセルは馬名の後に生年や毛色が続くので、リンクがあればその文字列を使う
+    link = cell.find("a")
+    text = (link or cell).get_text(strip=True)
+    return text or None
+
+def get_cell_link_id(cell):
+    # <a href="/horse/ped/2010105827/"> -> "2010105827"
+    return get_link_id(cell) if cell is not None else None
 
 def merge_race_info_and_refunds(info, refunds):
     record = {}
     for column in RACE_INFO_COLUMNS:
-        if column in info:
-            record[column] = info[column]
-        else:
-            record[column] = [None]
+        record[column] = info.get(column)
     for column in RACE_REFUND_COLUMNS:
-        if column in refunds:
-            record[column] = refunds[column]
-        else:
-            record[column] = [None]
-    return pd.DataFrame.from_dict(record)
+        record[column] = refunds.get(column)
+    return RaceInfo(**record)
 
 def collect_data(soup, race_id):
-    race_info = get_race_info(soup, race_id)
-    race_table = soup.find("table", "race_table_01 nk_tb_common").find_all("tr")
-    odds_tables = soup.find_all("table", "pay_table_01")
-    race_refunds = get_refunds(odds_tables)
-    race_info_with_refunds = merge_race_info_and_refunds(race_info, race_refunds)
-    race_records = get_race_records(race_table, race_refunds, race_id)
-    return race_info_with_refunds, race_records
+    with metrics.timer("extract"):
+        race_info = get_race_info(soup, race_id)
+        race_table = soup.find("table", "race_table_01 nk_tb_common").find_all("tr")
+        odds_tables = soup.find_all("table", "pay_table_01")
+        race_refunds = get_refunds(odds_tables)
+        payouts = get_payouts(odds_tables, race_id)
+        race_info_with_refunds = merge_race_info_and_refunds(race_info, race_refunds)
+        race_records = get_race_records(race_table, payouts, race_id)
+        return race_info_with_refunds, race_records, payouts
+
+def to_frames(race_info, race_records):
+    # pandas が必要な場合だけ DataFrame に変換する
+    import pandas as pd
+    with metrics.timer("frame"):
+        df_race_info = pd.DataFrame([race_info], columns=RaceInfo._fields)
+        df_race_records = pd.DataFrame(race_records, columns=RaceRecord._fields)
+        for df, dtypes in ((df_race_info, RACE_INFO_DTYPES), (df_race_records, RACE_DATA_DTYPES)):
+            for column, dtype in dtypes.items():
+                if isinstance(dtype, list):
+                    dtype = pd.CategoricalDtype(dtype)
+                df[column] = df[column].astype(dtype)
+    return df_race_info, df_race_records
+
+def payouts_to_frame(payouts):
+    import pandas as pd
+    df_payouts = pd.DataFrame(payouts, columns=Payout._fields)
+    for column, dtype in PAYOUT_DTYPES.items():
+        if isinstance(dtype, list):
+            dtype = pd.CategoricalDtype(dtype)
+        df_payouts[column] = df_payouts[column].astype(dtype)
+    return df_payouts
+
+def iter_races(start_year, end_year, exist_race_ids=(), fetcher=None, stats=None):
+    # 取得したレースから順に (RaceInfo, [RaceRecord], [Payout]) を返す
+    # 取得待ちのページは Fetcher のキューに収まる分だけなので、何年分でもメモリは一定
+    from fetcher import Fetcher
+    if fetcher is None:
+        fetcher = Fetcher()
+    for race_id, content in fetcher.discover_races(start_year, end_year, exist_race_ids, stats):
+        soup = parse_html(content)
+        if soup is None:
+            continue
+        try:
+            result = collect_data(soup, race_id)
+        except ParseError as exception:
+            # 1レースのページが壊れていても、残りのレースは返し続ける
+            print("\033[31m")
+            print("Could not parse race_id %s" % race_id)
+            print(exception)
+            print("\033[0m")
+            metrics.inc("parse_errors_total")
+            if stats is not None:
+                stats["parse_errors"] = stats.get("parse_errors", 0) + 1
+            continue
+        yield result
 
 def to_sec(str_time):
     time = str_time.split(":")
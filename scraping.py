@@ -2,160 +2,205 @@
 # coding: utf-8
 
 import argparse
-import pandas as pd
-import re
-import requests
+import csv
+import heapq
+import os
 import time
-from bs4 import BeautifulSoup
+from tqdm import tqdm
+import metrics
+import pipeline
+import scraper
+from cache import HtmlStore, MissingRaceIds
+from fetcher import Fetcher
+
+# 年ごとの csv の列（先頭の列はインデックスとして race_id）
+COLUMNS = [
+    "year",              # 年
+    "month",             # 月
+    "day",               # 日
+    "venue",             # 開催場所
+    "race_number",       # 何レース目
+    "race_name",         # レース名
+    "course_type",       # コース
+    "course_direction",  # 左右
+    "course_distance",   # 距離
+    "weather",           # 天候
+    "course_state",      # 馬場状態
+    "rank",              # 着順
+    "slot",              # 枠番
+    "horse_name",        # 馬名
+    "horse_gender",      # 性別
+    "horse_age",         # 年齢
+    "jockey_weight",     # 斤量
+    "jockey_name",       # 騎手名
+    "time",              # タイム
+    "last_time",         # 上り
+    "odds",              # 単勝のオッズ
+    "popularity",        # 人気
+    "horse_weight",      # 馬体重
+    "horse_weight_diff", # 馬体重の増減
+    "trainer"            # 調教師
+]
 
 def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--start_year", type=int, default=1986)
     parser.add_argument("--end_year", type=int, default=2020)
-    return(parser.parse_args())
-
-def get_html(race_id):
-    url_base = "https://db.netkeiba.com/race/"
-    url = url_base + race_id
-    html = requests.get(url)
-    html.encoding = "EUC-JP"
-    soup = BeautifulSoup(html.text, "html.parser")
-    if soup.find_all("table", "race_table_01 nk_tb_common") == []:
-        return None
-    else:
-        return soup
-
-def get_race_info(soup, venue_number, race_number):
-    date_text = soup.find("div", "data_intro").find("p", "smalltxt").get_text(strip=True)
-    date = re.match(r"(\d+)年(\d+)月(\d+)日.+", date_text)
-    year = date.group(1)
-    month = date.group(2)
-    day = date.group(3)
-
-    venue_names = [None, "札幌", "函館", "福島", "新潟", "東京", "中山", "中京", "京都", "阪神", "小倉"]
-    venue = venue_names[venue_number]
-
-    race_name = soup.find("dl", "racedata fc").find("h1").get_text(strip=True)
-
-    conditions = soup.find("dl", "racedata fc").find("span").get_text(strip=True).replace("\xa0", "").split("/")
-    course_type = ""
-    if "芝" in conditions[0]:
-        course_type += "芝"
-    if "ダ" in conditions[0]:
-        course_type += "ダ"
-
-    if "左" in conditions[0]:
-        course_direction = "左"
-    elif "右" in conditions[0]:
-        course_direction = "右"
-    elif "障" in conditions[0]:
-        course_direction = "障"
-    elif "直線" in conditions[0]:
-        course_direction = "直"
-
-    course_distance = re.match(r".+([0-9]{4})m", conditions[0]).group(1)
-    weather = conditions[1].split(" : ")[1]
-    if course_type == "芝ダ":
-        states = re.match(r"芝 : (.+)ダート : (.+)", conditions[2])
-        course_state = states.group(1) + "/" + states.group(2)
-    else:
-        course_state = conditions[2].split(" : ")[1]
-
-    return year, month, day, venue, race_number, race_name, course_type, course_direction, course_distance, weather, course_state
-
-def to_sec(time):
-    t = time.split(":")
-    return float(t[0]) * 60 + float(t[1])
-
-def get_race_records(table):
-    records = []
-    for i in range(1, len(table)):
-        row = table[i].find_all("td")
-        rank = row[0].get_text(strip=True)
-        if not rank.isdecimal():
+    parser.add_argument("--output_dir", type=str, default=".")
+    parser.add_argument("--chunk_races", type=int, default=100)
+    parser.add_argument("--base_url", type=str, default=scraper.URL_BASE)
+    parser.add_argument("--rate", type=float, default=1.0)
+    parser.add_argument("--max_rate", type=float, default=None)
+    parser.add_argument("--max_in_flight", type=int, default=4)
+    parser.add_argument("--cache_dir", type=str, default="html_cache")
+    parser.add_argument("--replay", action="store_true")
+    parser.add_argument("--missing_path", type=str, default="missing_race_ids.tsv")
+    parser.add_argument("--recheck_days", type=int, default=7)
+    parser.add_argument("--parse_workers", type=int, default=None)
+    parser.add_argument("--metrics_port", type=int, default=None)
+    parser.add_argument("--metrics_json", type=str, default=None)
+    parser.add_argument("--metrics_interval", type=float, default=60)
+    args = parser.parse_args()
+    # --replay はキャッシュしたページから読むので、キャッシュなしでは使えない
+    if args.replay and not args.cache_dir:
+        parser.error("--replay requires --cache_dir")
+    return args
+
+def to_rows(race_info, race_records):
+    rows = []
+    for record in race_records:
+        # 以前の {年}.csv と同じく、増えたときだけ + を付け、変わらなければ 0 にする
+        horse_weight_diff = record.horse_weight_diff
+        if horse_weight_diff is not None:
+            horse_weight_diff = str(horse_weight_diff) if horse_weight_diff <= 0 \
+                else "+%d" % horse_weight_diff
+        rows.append((
+            race_info.race_id, race_info.year, race_info.month, race_info.day, race_info.venue,
+            race_info.race_number, race_info.race_name, race_info.course_type,
+            race_info.course_direction, race_info.course_distance, race_info.weather,
+            race_info.course_state, record.rank, record.slot, record.horse_name,
+            record.horse_gender, record.horse_age, record.jockey_weight, record.jockey_name,
+            record.goal_time, record.last_time, record.odds, record.popularity,
+            record.horse_weight, horse_weight_diff, record.trainer,
+        ))
+    return rows
+
+def read_chunk(path, start, end):
+    # part ファイルの start から end の位置までの行を読む
+    with open(path, "rb") as f:
+        f.seek(start)
+        lines = iter(lambda: f.readline() if f.tell() < end else b"", b"")
+        yield from csv.reader(line.decode("utf-8") for line in lines)
+
+class YearWriter:
+    # {年}.csv.part に chunk_races レースずつ race_id 順に並べて追記し、
+    # 書き終えた各チャンクの終わりの位置を {年}.csv.ckpt に1行ずつ記録する
+    # 途中で落ちた場合は ckpt の最後の位置まで戻し、そこまでにあるレースは取得し直さない
+    # 年の最後にチャンクをマージして race_id 順の {年}.csv にする
+    def __init__(self, path, chunk_races=100):
+        self.path = path
+        self.part_path = path + ".part"
+        self.checkpoint_path = path + ".ckpt"
+        self.chunk_races = chunk_races
+        self.rows = []
+        self.pending = 0
+
+        self.offsets = []
+        if os.path.isfile(self.checkpoint_path):
+            with open(self.checkpoint_path) as f:
+                self.offsets = [int(line) for line in f if line.strip()]
+        with open(self.part_path, "ab") as f:
+            f.truncate(self.offsets[-1] if self.offsets else 0)
+        with open(self.part_path, newline="", encoding="utf-8") as f:
+            self.race_ids = {row[0] for row in csv.reader(f)}
+
+    def append(self, race_info, race_records):
+        self.rows += to_rows(race_info, race_records)
+        self.pending += 1
+        print("Inserted race_id %s" % race_info.race_id)
+        if self.pending >= self.chunk_races:
+            self.flush()
+
+    def flush(self):
+        if self.pending == 0:
+            return
+        # 同じレースの行は着順のまま、レースは race_id 順にする
+        self.rows.sort(key=lambda row: str(row[0]))
+        with open(self.part_path, "a", newline="", encoding="utf-8") as f:
+            csv.writer(f, lineterminator="\n").writerows(self.rows)
+            f.flush()
+            os.fsync(f.fileno())
+            self.offsets.append(f.tell())
+        with open(self.checkpoint_path + ".tmp", "w") as f:
+            f.write("".join("%d\n" % offset for offset in self.offsets))
+        os.replace(self.checkpoint_path + ".tmp", self.checkpoint_path)
+        self.rows = []
+        self.pending = 0
+
+    def close(self):
+        # 年の全てのレースを書き終えたときだけ呼ぶ
+        self.flush()
+        chunks = [read_chunk(self.part_path, start, end)
+                  for start, end in zip([0] + self.offsets[:-1], self.offsets)]
+        with open(self.path + ".tmp", "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f, lineterminator="\n")
+            writer.writerow([""] + COLUMNS)
+            writer.writerows(heapq.merge(*chunks, key=lambda row: row[0]))
+        os.replace(self.path + ".tmp", self.path)
+        os.remove(self.part_path)
+        os.remove(self.checkpoint_path)
+
+def scraping(start_year, end_year, output_dir=".", chunk_races=100, rate=1.0, max_in_flight=4,
+             cache_dir="html_cache", replay=False,
+             missing_path="missing_race_ids.tsv", recheck_days=7, parse_workers=None,
+             base_url=scraper.URL_BASE, max_rate=None):
+    print("Start scraping data from %d to %d" % (start_year, end_year))
+
+    os.makedirs(output_dir, exist_ok=True)
+    store = HtmlStore(cache_dir) if cache_dir else None
+    if not replay:
+        missing = MissingRaceIds(missing_path, recheck_days) if missing_path else None
+        fetcher = Fetcher(rate, max_in_flight, store, missing, base_url=base_url, max_rate=max_rate)
+
+    for y in range(start_year, end_year + 1):
+        path = os.path.join(output_dir, f"{y}.csv")
+        if os.path.isfile(path):
+            print("Skipped %d, %s already exists" % (y, path))
             continue
-        slot = row[1].get_text(strip=True)
-        horse_name = row[3].get_text(strip=True)
-        horse_gender = row[4].get_text(strip=True)[0]
-        horse_age = row[4].get_text(strip=True)[1:]
-        jockey_weight = row[5].get_text(strip=True)
-        jockey_name = row[6].get_text(strip=True)
-        time = to_sec(row[7].get_text(strip=True))
-        last_time = row[11].get_text(strip=True)
-        odds = row[12].get_text(strip=True)
-        popularity = row[13].get_text(strip=True)
-        weight = re.match(r"(\d+)\((\D*\d+)\)", row[14].get_text(strip=True))
-        if weight is not None:
-            horse_weight = weight.group(1)
-            horse_weight_diff = weight.group(2)
+        writer = YearWriter(path, chunk_races)
+        if writer.race_ids:
+            print("Resuming %d from %d races" % (y, len(writer.race_ids)))
+        stats = {}
+        if replay:
+            races = store.replay_races(y, y, writer.race_ids)
         else:
-            horse_weight = ""
-            horse_weight_diff = ""
-        trainer = row[18].get_text(strip=True)
-        record = (rank, slot, horse_name, horse_gender, horse_age, jockey_weight, jockey_name, time, last_time, odds, popularity, horse_weight, horse_weight_diff, trainer)
-        records.append(record)
-    return records
-
-def scraping(start_year, end_year):
-    df_columns = [
-        "year",              # 年
-        "month",             # 月
-        "day",               # 日
-        "venue",             # 開催場所
-        "race_number",       # 何レース目
-        "race_name",         # レース名
-        "course_type",       # コース
-        "course_direction",  # 左右
-        "course_distance",   # 距離
-        "weather",           # 天候
-        "course_state",      # 馬場状態
-        "rank",              # 着順
-        "slot",              # 枠番
-        "horse_name",        # 馬名
-        "horse_gender",      # 性別
-        "horse_age",         # 年齢
-        "jockey_weight",     # 斤量
-        "jockey_name",       # 騎手名
-        "time",              # タイム
-        "last_time",         # 上り
-        "odds",              # 単勝のオッズ
-        "popularity",        # 人気
-        "horse_weight",      # 馬体重
-        "horse_weight_diff", # 馬体重の増減
-        "trainer"            # 調教師
-    ]
-
-    df = pd.DataFrame(columns = df_columns)
-
-    years = list(range(start_year, end_year+1))
-    venues = list(range(1, 11))
-    numbers = list(range(1, 11))
-    days = list(range(1, 11))
-    races = list(range(1, 13))
-
-    for y in years:
-        for v in venues:
-            for n in numbers:
-                for d in days:
-                    for r in races:
-                        race_id = f"{y}{v:02}{n:02}{d:02}{r:02}"
-                        soup = get_html(race_id)
-                        if soup is not None:
-                            race_info = get_race_info(soup, v, r)
-                            race_table = soup.find("table", "race_table_01 nk_tb_common").find_all("tr")
-                            race_records = get_race_records(race_table)
-
-                            records = []
-                            for record in race_records:
-                                records.append(race_info + record)
-
-                            record_df = pd.DataFrame(records, columns = df.columns, index = [race_id] * len(records))
-                            print(record_df)
-                            df = df.append(record_df)
-                        time.sleep(1)
-        df.to_csv(f"{y}.csv")
-        df = pd.DataFrame(columns = df_columns)
-
-if __name__ == '__main__':
-    args = get_args()
-    scraping(args.start_year, args.end_year)
+            races = fetcher.discover_races(y, y, writer.race_ids, stats)
+
+        for race_id, result in tqdm(pipeline.parse_races(races, parse_workers)):
+            if result is None:
+                continue
+            race_info, race_records, _ = result
+            with metrics.timer("write"):
+                writer.append(race_info, race_records)
+            metrics.inc("races_written_total")
+            metrics.inc("rows_written_total", len(race_records))
+        # 今年のレースや、取得できずに飛ばした開催場所がある年は .part のまま残し、次に実行したときに続きを探索する
+        if y < time.localtime().tm_year and not stats.get("failed_shards"):
+            writer.close()
+        else:
+            writer.flush()
+            print("Kept %s for %d, the rest will be probed on the next run" % (writer.part_path, y))
+
+        if not replay:
+            print("Probed %d of %d candidate race_ids in %d (skipped %d)"
+                  % (stats["probed"], stats["candidates"], y, stats["skipped"]))
+
+if __name__ == "__main__":
+    ARGS = get_args()
+    metrics.start(ARGS.metrics_port, ARGS.metrics_json, ARGS.metrics_interval)
+    scraping(ARGS.start_year, ARGS.end_year, ARGS.output_dir, ARGS.chunk_races,
+             ARGS.rate, ARGS.max_in_flight, ARGS.cache_dir, ARGS.replay,
+             ARGS.missing_path, ARGS.recheck_days, ARGS.parse_workers,
+             ARGS.base_url, ARGS.max_rate)
+    if ARGS.metrics_json:
+        metrics.dump_json(ARGS.metrics_json)
@@ -2,11 +2,21 @@
 # coding: utf-8
 
 import argparse
-import time
+import csv
+import datetime
+import fcntl
+import io
 import os
-import pandas as pd
+import struct
+import time
+from contextlib import contextmanager
 from tqdm import tqdm
+import metrics
+import pipeline
 import scraper
+from cache import HtmlStore, MissingRaceIds, PageValidators
+from fetcher import Fetcher
+from jobs import JobQueue, LeaseLost, SharedRateLimiter
 
 def get_args():
     parser = argparse.ArgumentParser()
@@ -14,39 +24,357 @@ def get_args():
     parser.add_argument("--end_year", type=int, default=2020)
     parser.add_argument("--csv_info_path", type=str, default="netkeiba_info.csv")
     parser.add_argument("--csv_data_path", type=str, default="netkeiba_data.csv")
-    return parser.parse_args()
+    parser.add_argument("--csv_payout_path", type=str, default="netkeiba_payout.csv")
+    parser.add_argument("--base_url", type=str, default=scraper.URL_BASE)
+    parser.add_argument("--rate", type=float, default=1.0)
+    parser.add_argument("--max_rate", type=float, default=None)
+    parser.add_argument("--max_in_flight", type=int, default=4)
+    parser.add_argument("--cache_dir", type=str, default="html_cache")
+    parser.add_argument("--replay", action="store_true")
+    parser.add_argument("--incremental", action="store_true")
+    parser.add_argument("--refresh_weeks", type=int, default=None)
+    parser.add_argument("--validators_path", type=str, default="page_validators.tsv")
+    parser.add_argument("--missing_path", type=str, default="missing_race_ids.tsv")
+    parser.add_argument("--recheck_days", type=int, default=7)
+    parser.add_argument("--parse_workers", type=int, default=None)
+    parser.add_argument("--job_path", type=str, default=None)
+    parser.add_argument("--lease_seconds", type=float, default=300)
+    parser.add_argument("--max_attempts", type=int, default=3)
+    parser.add_argument("--metrics_port", type=int, default=None)
+    parser.add_argument("--metrics_json", type=str, default=None)
+    parser.add_argument("--metrics_interval", type=float, default=60)
+    parser.add_argument("--commit_races", type=int, default=100)
+    parser.add_argument("--commit_seconds", type=float, default=10.0)
+    args = parser.parse_args()
+    # --replay はキャッシュしたページから読むので、キャッシュなしでは使えない
+    if args.replay and not args.cache_dir:
+        parser.error("--replay requires --cache_dir")
+    # --replay はリクエストを送らないので、再検証はできない
+    if args.replay and args.refresh_weeks:
+        parser.error("--replay cannot be used with --refresh_weeks")
+    return args
+
+# 索引のファイル（info の csv のパス + ".idx"）
+# 先頭に索引を作ったときの info・data・payout の csv の大きさ、続いてレースごとに
+# race_id、開催日(yyyymmdd)、各 csv でのそのレースの行の (開始位置, バイト数) を並べる
+INDEX_HEADER = struct.Struct("<3q")
+INDEX_ENTRY = struct.Struct("<qi6q")
+CSV_KEYS = ("info", "data", "payout")
+
+def get_index_path(csvpath):
+    return csvpath["info"] + ".idx"
+
+def get_journal_path(csvpath):
+    return csvpath["info"] + ".journal"
+
+def get_sizes(csvpath):
+    paths = [csvpath[key] for key in CSV_KEYS] + [get_index_path(csvpath)]
+    return [os.path.getsize(path) if os.path.isfile(path) else 0 for path in paths]
+
+def to_bytes(rows):
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator="\n").writerows(rows)
+    return buffer.getvalue().encode("utf-8")
+
+def append_file(path, content):
+    with open(path, "ab") as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+
+def recover_csv(csvpath):
+    # ジャーナルが残っていれば書き込み途中で落ちたバッチがあるので、書き込む前の大きさに戻す
+    journal_path = get_journal_path(csvpath)
+    if not os.path.isfile(journal_path):
+        return
+    with open(journal_path) as f:
+        sizes = [int(value) for value in f.read().split()]
+    paths = [csvpath[key] for key in CSV_KEYS] + [get_index_path(csvpath)]
+    for path, size in zip(paths, sizes):
+        if os.path.isfile(path) and os.path.getsize(path) > size:
+            with open(path, "r+b") as f:
+                f.truncate(size)
+    os.remove(journal_path)
+    print("\033[31mRolled back an incomplete batch in %s\033[0m" % csvpath["info"])
+
+def scan_csv(path):
+    # race_id ごとに (開始位置, バイト数, 最初の行) を返す
+    # 同じレースの行は続けて書かれているので、最初の行から最後の行までを1つの範囲にする
+    spans = {}
+    if not os.path.isfile(path):
+        return spans
+    offset = 0
+    with open(path, "rb") as f:
+        for line in f:
+            race_id = line.split(b",", 1)[0].decode()
+            if race_id in spans:
+                start, _, row = spans[race_id]
+                spans[race_id] = (start, offset + len(line) - start, row)
+            else:
+                spans[race_id] = (offset, len(line), line)
+            offset += len(line)
+    return spans
+
+def build_index(csvpath):
+    # 索引がない、または csv が他の方法で書き換えられた場合に、csv を1回ずつ読んで作り直す
+    spans = [scan_csv(csvpath[key]) for key in CSV_KEYS]
+    path = get_index_path(csvpath)
+    with open(path + ".tmp", "wb") as f:
+        f.write(INDEX_HEADER.pack(*get_sizes(csvpath)[:3]))
+        for race_id, (_, _, line) in spans[0].items():
+            row = next(csv.reader([line.decode("utf-8")]))
+            entry = [int(race_id), int(row[1]) * 10000 + int(row[2]) * 100 + int(row[3])]
+            for key_spans in spans:
+                start, length, _ = key_spans.get(race_id, (0, 0, None))
+                entry += [start, length]
+            f.write(INDEX_ENTRY.pack(*entry))
+    os.replace(path + ".tmp", path)
+
+def check_index(csvpath):
+    # lock_csv の中で呼ぶ
+    recover_csv(csvpath)
+    path = get_index_path(csvpath)
+    if os.path.isfile(path):
+        with open(path, "rb") as f:
+            header = f.read(INDEX_HEADER.size)
+        if len(header) == INDEX_HEADER.size \
+           and list(INDEX_HEADER.unpack(header)) == get_sizes(csvpath)[:3]:
+            return
+    build_index(csvpath)
+
+def read_index(csvpath):
+    # race_id -> (開催日, [info の位置, バイト数, data の位置, バイト数, payout の位置, バイト数])
+    with lock_csv(csvpath):
+        check_index(csvpath)
+        with open(get_index_path(csvpath), "rb") as f:
+            content = f.read()
+    return {str(race_id): (date, offsets) for race_id, date, *offsets
+            in INDEX_ENTRY.iter_unpack(content[INDEX_HEADER.size:])}
 
 def get_exist_race_ids(start_year, end_year, csvpath):
-    if os.path.isfile(csvpath["info"]):
-        df_info = pd.read_csv(csvpath["info"], header=None, usecols=[0, 1])
-        df_info = df_info[df_info[1] >= start_year]
-        df_info = df_info[df_info[1] <= end_year]
-        exist_race_ids = [str(id) for id in df_info[0].tolist()]
-        return exist_race_ids
-    return []
-
-def insert_into_csv(race_info, race_data, csvpath):
-    race_info.to_csv(csvpath["info"], mode="a", header=False, index=False)
-    race_data.to_csv(csvpath["data"], mode="a", header=False, index=False)
-    print("Inserted race_id %s" % race_info["race_id"].values[0])
-
-def scraping(start_year, end_year, csvpath):
-    print("Start scraping data from %d to %d" % (start_year, end_year))
+    return [race_id for race_id, (date, _) in read_index(csvpath).items()
+            if start_year <= date // 10000 <= end_year]
+
+def get_recent_race_ids(weeks, csvpath):
+    since = datetime.date.today() - datetime.timedelta(weeks=weeks)
+    since = since.year * 10000 + since.month * 100 + since.day
+    return [race_id for race_id, (date, _) in read_index(csvpath).items() if date >= since]
+
+def get_latest_race_ids(csvpath):
+    return scraper.get_latest_race_ids(list(read_index(csvpath)))
+
+def get_race_rows(race_id, csvpath, index=None):
+    # 1レース分の info・data・payout の行を、索引の位置から読む
+    entry = (index or read_index(csvpath)).get(str(race_id))
+    if entry is None:
+        return None
+    _, offsets = entry
+    rows = {}
+    for key, start, length in zip(CSV_KEYS, offsets[0::2], offsets[1::2]):
+        content = b""
+        if length:
+            with open(csvpath[key], "rb") as f:
+                f.seek(start)
+                content = f.read(length)
+        rows[key] = [row for row in csv.reader(content.decode("utf-8").splitlines())
+                     if row[0] == str(race_id)]
+    return rows
+
+@contextmanager
+def lock_csv(csvpath):
+    # 複数のプロセスから書き込んでも行が混ざらないように、ロックを取ってから書き込む
+    with open(csvpath["info"] + ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+class CsvWriter:
+    # commit_races レース分または commit_seconds 秒ごとに、3つの csv と索引にまとめて追記する
+    # 追記する前の各ファイルの大きさをジャーナルに書いておき、全て書き終えたら消す
+    # 途中で落ちた場合は次にロックを取ったときにジャーナルの大きさまで戻すので、
+    # race_info だけ、または race_data だけが書かれたレースは残らない
+    # 書き終えたら、そのレースの race_id のリストで on_commit を呼ぶ
+    def __init__(self, csvpath, commit_races=100, commit_seconds=10.0, on_commit=None):
+        self.csvpath = csvpath
+        self.commit_races = commit_races
+        self.commit_seconds = commit_seconds
+        self.on_commit = on_commit
+        self.pending = []
+        self.last_commit = time.time()
+
+    def insert(self, race_info, race_records, payouts):
+        date = race_info.year * 10000 + race_info.month * 100 + race_info.day
+        self.pending.append((int(race_info.race_id), date,
+                             [to_bytes([race_info]), to_bytes(race_records), to_bytes(payouts)]))
+        print("Inserted race_id %s" % race_info.race_id)
+        if len(self.pending) >= self.commit_races \
+           or time.time() - self.last_commit >= self.commit_seconds:
+            self.commit()
+
+    def commit(self):
+        self.last_commit = time.time()
+        if not self.pending:
+            return
+        with lock_csv(self.csvpath):
+            check_index(self.csvpath)
+            sizes = get_sizes(self.csvpath)
+            journal_path = get_journal_path(self.csvpath)
+            with open(journal_path + ".tmp", "w") as f:
+                f.write(" ".join(str(size) for size in sizes))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(journal_path + ".tmp", journal_path)
+
+            offsets = sizes[:3]
+            contents = [[], [], []]
+            entries = []
+            for race_id, date, parts in self.pending:
+                entry = [race_id, date]
+                for i, part in enumerate(parts):
+                    entry += [offsets[i], len(part)]
+                    offsets[i] += len(part)
+                    contents[i].append(part)
+                entries.append(INDEX_ENTRY.pack(*entry))
+            # race_info を最後に書く
+            for i in (1, 2, 0):
+                append_file(self.csvpath[CSV_KEYS[i]], b"".join(contents[i]))
+            append_file(get_index_path(self.csvpath), b"".join(entries))
+            with open(get_index_path(self.csvpath), "r+b") as f:
+                f.write(INDEX_HEADER.pack(*offsets))
+                f.flush()
+                os.fsync(f.fileno())
+            os.remove(journal_path)
+        if self.on_commit is not None:
+            self.on_commit([str(race_id) for race_id, _, _ in self.pending])
+        self.pending = []
+
+    def close(self):
+        self.commit()
+
+def upsert_into_csv(results, csvpath):
+    # 置き換えるレースの行を除いてファイルを書き直し、新しい行を追記する
+    race_ids = {str(race_info.race_id) for race_info, _, _ in results}
+    rows = {
+        "info": [race_info for race_info, _, _ in results],
+        "data": [record for _, race_records, _ in results for record in race_records],
+        "payout": [payout for _, _, payouts in results for payout in payouts],
+    }
+    with lock_csv(csvpath):
+        recover_csv(csvpath)
+        for key in CSV_KEYS:
+            path = csvpath[key]
+            with open(path + ".tmp", "w", newline="", encoding="utf-8") as out:
+                writer = csv.writer(out, lineterminator="\n")
+                if os.path.isfile(path):
+                    with open(path, newline="", encoding="utf-8") as f:
+                        writer.writerows(row for row in csv.reader(f) if row[0] not in race_ids)
+                writer.writerows(rows[key])
+            os.replace(path + ".tmp", path)
+        build_index(csvpath)
+    for race_id in sorted(race_ids):
+        print("Updated race_id %s" % race_id)
+
+def scraping(start_year, end_year, csvpath, rate=1.0, max_in_flight=4,
+             cache_dir="html_cache", replay=False,
+             missing_path="missing_race_ids.tsv", recheck_days=7, parse_workers=None,
+             incremental=False,
+             job_path=None, lease_seconds=300, max_attempts=3,
+             refresh_weeks=None, validators_path="page_validators.tsv",
+             base_url=scraper.URL_BASE, max_rate=None, commit_races=100, commit_seconds=10.0):
+    if incremental:
+        print("Start scraping new races")
+    elif refresh_weeks:
+        print("Start revalidating races in the last %d weeks" % refresh_weeks)
+    else:
+        print("Start scraping data from %d to %d" % (start_year, end_year))
 
     exist_race_ids = get_exist_race_ids(start_year, end_year, csvpath)
-    race_ids = sorted(list(set(scraper.get_race_ids(start_year, end_year)) - set(exist_race_ids)))
-
-    for race_id in tqdm(race_ids):
-        time_start = time.time()
-        soup = scraper.get_html(race_id)
-        if soup is not None:
-            df_race_info, df_race_records = scraper.collect_data(soup, race_id)
-            insert_into_csv(df_race_info, df_race_records, csvpath)
-        elapsed_time = time.time() - time_start
-        if elapsed_time < 1:
-            time.sleep(1 - elapsed_time)
+    store = HtmlStore(cache_dir) if cache_dir else None
+    validators = PageValidators(validators_path) if validators_path else None
+    stats = {}
+    jobs = None
+    if replay:
+        races = store.replay_races(start_year, end_year, exist_race_ids)
+    elif refresh_weeks:
+        fetcher = Fetcher(rate, max_in_flight, store, validators=validators,
+                          base_url=base_url, max_rate=max_rate)
+        races = fetcher.refresh_races(get_recent_race_ids(refresh_weeks, csvpath), stats)
+    elif incremental:
+        # 未開催のレースはすぐに存在するようになるので、存在しなかった race_id の記録は使わない
+        fetcher = Fetcher(rate, max_in_flight, store, validators=validators,
+                          base_url=base_url, max_rate=max_rate)
+        races = fetcher.discover_races_after(get_latest_race_ids(csvpath), start_year,
+                                             time.localtime().tm_year, stats)
+    elif job_path:
+        # 同じ job_path を指定したプロセス同士でシャードを分担し、リクエストの上限も共有する
+        jobs = JobQueue(job_path, lease_seconds, max_attempts)
+        jobs.add((y, v) for y in range(start_year, end_year + 1) for v in range(1, 11))
+        missing = MissingRaceIds(missing_path, recheck_days) if missing_path else None
+        fetcher = Fetcher(rate, max_in_flight, store, missing, SharedRateLimiter(job_path, rate),
+                          validators, base_url, max_rate)
+        races = fetcher.discover_jobs(jobs, lambda year: get_exist_race_ids(year, year, csvpath),
+                                      stats)
+    else:
+        missing = MissingRaceIds(missing_path, recheck_days) if missing_path else None
+        fetcher = Fetcher(rate, max_in_flight, store, missing, validators=validators,
+                          base_url=base_url, max_rate=max_rate)
+        races = fetcher.discover_races(start_year, end_year, exist_race_ids, stats)
+
+    # 再検証で変わったレースは最後にまとめて置き換える
+    changed = []
+    # 検証子は、書き込みが終わってから保存する
+    writer = CsvWriter(csvpath, commit_races, commit_seconds,
+                       None if replay else fetcher.commit_validators)
+    try:
+        for race_id, result in tqdm(pipeline.parse_races(races, parse_workers)):
+            if isinstance(race_id, tuple):
+                # シャードのレースを全て書き込んだので、追記してから完了にする
+                writer.commit()
+                try:
+                    jobs.complete(race_id)
+                except LeaseLost as exception:
+                    print("\033[31m%s\033[0m" % exception)
+                continue
+            if result is None:
+                if not replay:
+                    fetcher.discard_validators([race_id])
+                continue
+            if refresh_weeks:
+                changed.append(result)
+                continue
+            race_info, race_records, payouts = result
+            with metrics.timer("write"):
+                writer.insert(race_info, race_records, payouts)
+            metrics.inc("races_written_total")
+            metrics.inc("rows_written_total", len(race_records))
+    finally:
+        writer.close()
+        if jobs is not None:
+            jobs.close()
+    if changed:
+        with metrics.timer("write"):
+            upsert_into_csv(changed, csvpath)
+        fetcher.commit_validators(race_info.race_id for race_info, _, _ in changed)
+        metrics.inc("races_written_total", len(changed))
+        metrics.inc("rows_written_total", sum(len(race_records) for _, race_records, _ in changed))
+
+    if refresh_weeks:
+        print("Revalidated %d races (%d changed), sent %d requests"
+              % (stats.get("checked", 0), stats.get("changed", 0), fetcher.requests))
+    elif not replay:
+        print("Probed %d of %d candidate race_ids (skipped %d), sent %d requests"
+              % (stats.get("probed", 0), stats.get("candidates", 0), stats.get("skipped", 0),
+                 fetcher.requests))
 
 if __name__ == "__main__":
     ARGS = get_args()
+    metrics.start(ARGS.metrics_port, ARGS.metrics_json, ARGS.metrics_interval)
     scraping(ARGS.start_year, ARGS.end_year,
-             {"info": ARGS.csv_info_path, "data": ARGS.csv_data_path})
+             {"info": ARGS.csv_info_path, "data": ARGS.csv_data_path,
+              "payout": ARGS.csv_payout_path},
+             ARGS.rate, ARGS.max_in_flight, ARGS.cache_dir, ARGS.replay,
+             ARGS.missing_path, ARGS.recheck_days, ARGS.parse_workers, ARGS.incremental,
+             ARGS.job_path, ARGS.lease_seconds, ARGS.max_attempts,
+             ARGS.refresh_weeks, ARGS.validators_path, ARGS.base_url, ARGS.max_rate,
+             ARGS.commit_races, ARGS.commit_seconds)
+    if ARGS.metrics_json:
+        metrics.dump_json(ARGS.metrics_json)
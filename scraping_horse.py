@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import argparse
+import csv
+import os
+import sqlite3
+import time
+from tqdm import tqdm
+import metrics
+import scraper
+from cache import HtmlStore
+from fetcher import Fetcher
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backend", choices=["csv", "sqlite"], default="sqlite")
+    parser.add_argument("--dbpath", type=str, default="netkeiba.db")
+    parser.add_argument("--csv_data_path", type=str, default="netkeiba_data.csv")
+    parser.add_argument("--csv_horse_path", type=str, default="netkeiba_horse.csv")
+    parser.add_argument("--ttl_days", type=float, default=30)
+    parser.add_argument("--base_url", type=str, default=scraper.URL_BASE)
+    parser.add_argument("--rate", type=float, default=1.0)
+    parser.add_argument("--max_rate", type=float, default=None)
+    parser.add_argument("--max_in_flight", type=int, default=4)
+    parser.add_argument("--cache_dir", type=str, default="html_cache")
+    parser.add_argument("--commit_horses", type=int, default=100)
+    parser.add_argument("--metrics_port", type=int, default=None)
+    parser.add_argument("--metrics_json", type=str, default=None)
+    parser.add_argument("--metrics_interval", type=float, default=60)
+    return parser.parse_args()
+
+def get_missing_profile(horse_id):
+    # 200 でプロフィールのないページが返った馬は抹消として記録し、以後は取得し直さない
+    # エラーで取得できなかった馬は記録せず、次に実行したときに取得し直す
+    return scraper.HorseProfile(*([str(horse_id), None, 0] + [None] * (len(scraper.HORSE_COLUMNS) - 3)))
+
+def get_sqlite_horse_ids(dbpath, since):
+    # まだプロフィールを取得していない馬と、since より前に取得した現役の馬
+    connection = sqlite3.connect(dbpath)
+    cursor = connection.cursor()
+    cursor.execute("""
+        SELECT horse_id FROM horse WHERE horse_id IS NOT NULL AND horse_id != '' AND fetched_at IS NULL
+        ORDER BY horse_id
+    """)
+    new_ids = [str(row[0]) for row in cursor.fetchall()]
+    cursor.execute("""
+        SELECT horse_id FROM horse WHERE active = 1 AND fetched_at < ? ORDER BY horse_id
+    """, [since])
+    stale_ids = [str(row[0]) for row in cursor.fetchall()]
+    connection.close()
+    return new_ids, stale_ids
+
+class SqliteHorseWriter:
+    # race_data を保存したときに作られた horse の行にプロフィールを書き込む
+    def __init__(self, dbpath, commit_horses=100):
+        self.connection = sqlite3.connect(dbpath, timeout=60)
+        self.commit_horses = commit_horses
+        self.pending = 0
+        columns = scraper.HORSE_COLUMNS[2:] + ["fetched_at"]
+        self.sql = "UPDATE horse SET horse_name = COALESCE(?, horse_name), %s WHERE horse_id = ?" \
+                   % ", ".join("%s = ?" % column for column in columns)
+
+    def write(self, profile, fetched_at):
+        self.connection.execute(self.sql, [profile.horse_name] + list(profile[2:])
+                                + [fetched_at, profile.horse_id])
+        self.pending += 1
+        print("Inserted horse_id %s" % profile.horse_id)
+        if self.pending >= self.commit_horses:
+            self.commit()
+
+    def commit(self):
+        self.connection.commit()
+        self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+def read_horse_csv(path):
+    # horse_id -> 行（同じ馬の行は後のものが優先される）
+    horses = {}
+    if os.path.isfile(path):
+        with open(path, newline="", encoding="utf-8") as f:
+            for row in csv.reader(f):
+                horses[row[0]] = row
+    return horses
+
+def get_csv_horse_ids(csv_data_path, horses, since):
+    new_ids = set()
+    if os.path.isfile(csv_data_path):
+        with open(csv_data_path, newline="", encoding="utf-8") as f:
+            for row in csv.reader(f):
+                # 馬IDのリンクがない行は飛ばす
+                if row[1] and row[1] not in horses:
+                    new_ids.add(row[1])
+    stale_ids = [horse_id for horse_id, row in horses.items()
+                 if row[2] == "1" and float(row[-1]) < since]
+    return sorted(new_ids), sorted(stale_ids)
+
+class CsvHorseWriter:
+    # 取得した馬を commit_horses 頭ずつ追記し、最後に馬ごとに最新の1行だけを残して書き直す
+    def __init__(self, path, horses, commit_horses=100):
+        self.path = path
+        self.horses = horses
+        self.commit_horses = commit_horses
+        self.rows = []
+
+    def write(self, profile, fetched_at):
+        row = ["" if value is None else value for value in profile] + ["%.0f" % fetched_at]
+        self.rows.append(row)
+        self.horses[profile.horse_id] = row
+        print("Inserted horse_id %s" % profile.horse_id)
+        if len(self.rows) >= self.commit_horses:
+            self.commit()
+
+    def commit(self):
+        if self.rows:
+            with open(self.path, "a", newline="", encoding="utf-8") as f:
+                csv.writer(f, lineterminator="\n").writerows(self.rows)
+        self.rows = []
+
+    def close(self):
+        self.commit()
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path + ".tmp", "w", newline="", encoding="utf-8") as f:
+            csv.writer(f, lineterminator="\n").writerows(
+                self.horses[horse_id] for horse_id in sorted(self.horses))
+        os.replace(self.path + ".tmp", self.path)
+
+def scraping(backend, dbpath, csv_data_path, csv_horse_path, ttl_days=30,
+             base_url=scraper.URL_BASE, rate=1.0, max_rate=None, max_in_flight=4,
+             cache_dir="html_cache", commit_horses=100):
+    # 保存済みのレースに出走した馬のうち、まだ取得していない馬を1頭1回ずつ取得する
+    # 現役の馬は成績や馬主が変わるので、ttl_days 日ごとに取得し直す
+    print("Start scraping horse profiles")
+    since = time.time() - ttl_days * 24 * 60 * 60
+    if backend == "sqlite":
+        new_ids, stale_ids = get_sqlite_horse_ids(dbpath, since)
+        writer = SqliteHorseWriter(dbpath, commit_horses)
+    else:
+        horses = read_horse_csv(csv_horse_path)
+        new_ids, stale_ids = get_csv_horse_ids(csv_data_path, horses, since)
+        writer = CsvHorseWriter(csv_horse_path, horses, commit_horses)
+    print("Fetching %d new horses and refreshing %d active horses" % (len(new_ids), len(stale_ids)))
+
+    # 馬のページは race_id と同じ形式で html_cache/horse に保存し、他のスクリプトとも共有する
+    store = HtmlStore(os.path.join(cache_dir, "horse")) if cache_dir else None
+    fetcher = Fetcher(rate, max_in_flight, base_url=base_url, max_rate=max_rate, horse_store=store)
+    stats = {}
+    try:
+        for horse_id, content in tqdm(fetcher.fetch_horses(new_ids + stale_ids, stale_ids, stats),
+                                      total=len(new_ids) + len(stale_ids)):
+            # content が None なのは 200 でプロフィールのないページが返ったときだけ
+            if content is None:
+                profile = get_missing_profile(horse_id)
+            else:
+                soup = scraper.parse_horse_html(content)
+                if soup is None:
+                    print("\033[31mCould not parse horse_id %s\033[0m" % horse_id)
+                    metrics.inc("parse_errors_total", page="horse")
+                    continue
+                profile = scraper.get_horse_profile(soup, horse_id)
+            with metrics.timer("write"):
+                writer.write(profile, time.time())
+            metrics.inc("horses_written_total")
+    finally:
+        writer.close()
+
+    print("Fetched %d horses, sent %d requests" % (stats.get("fetched", 0), fetcher.requests))
+
+if __name__ == "__main__":
+    ARGS = get_args()
+    metrics.start(ARGS.metrics_port, ARGS.metrics_json, ARGS.metrics_interval)
+    if ARGS.backend == "sqlite":
+        import scraping_sqlite
+        scraping_sqlite.init_database(ARGS.dbpath)
+    scraping(ARGS.backend, ARGS.dbpath, ARGS.csv_data_path, ARGS.csv_horse_path, ARGS.ttl_days,
+             ARGS.base_url, ARGS.rate, ARGS.max_rate, ARGS.max_in_flight, ARGS.cache_dir,
+             ARGS.commit_horses)
+    if ARGS.metrics_json:
+        metrics.dump_json(ARGS.metrics_json)
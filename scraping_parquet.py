@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import argparse
+import os
+import shutil
+import time
+import uuid
+import pyarrow as pa
+import pyarrow.dataset as ds
+from tqdm import tqdm
+import metrics
+import pipeline
+import scraper
+from cache import HtmlStore, MissingRaceIds
+from fetcher import Fetcher
+
+NAME = pa.dictionary(pa.int32(), pa.string())
+
+RACE_INFO_SCHEMA = pa.schema(
+    [
+        ("race_id",          pa.int64()),
+        ("year",             pa.int16()),
+        ("month",            pa.int8()),
+        ("day",              pa.int8()),
+        ("venue",            NAME),
+        ("race_number",      pa.int8()),
+        ("race_name",        NAME),
+        ("course_type",      NAME),
+        ("course_direction", NAME),
+        ("course_distance",  pa.int16()),
+        ("weather",          NAME),
+        ("course_state",     NAME),
+    ] + [(column, pa.string()) for column in scraper.RACE_REFUND_COLUMNS]
+)
+
+RACE_DATA_SCHEMA = pa.schema([
+    ("race_id",           pa.int64()),
+    ("horse_id",          pa.string()),
+    ("rank",              pa.int8()),
+    ("slot",              pa.int8()),
+    ("horse_num",         pa.int8()),
+    ("horse_name",        NAME),
+    ("horse_gender",      NAME),
+    ("horse_age",         pa.int8()),
+    ("jockey_weight",     pa.float32()),
+    ("jockey_name",       NAME),
+    ("goal_time",         pa.float32()),
+    ("last_time",         pa.float32()),
+    ("odds",              pa.float32()),
+    ("popularity",        pa.int8()),
+    ("horse_weight",      pa.int16()),
+    ("horse_weight_diff", pa.int16()),
+    ("trainer",           NAME),
+    ("prize",             pa.float32()),
+    ("odds_place",        pa.float32()),
+    ("jockey_id",         pa.string()),
+    ("trainer_id",        pa.string()),
+    ("year",              pa.int16()),
+    ("venue",             NAME),
+])
+
+PAYOUT_SCHEMA = pa.schema([
+    ("race_id",     pa.int64()),
+    ("bet_type",    NAME),
+    ("combination", pa.int32()),
+    ("payout",      pa.int32()),
+    ("popularity",  pa.int16()),
+    ("year",        pa.int16()),
+    ("venue",       NAME),
+])
+
+PARTITIONING = ds.partitioning(pa.schema([("year", pa.int16()), ("venue", pa.string())]),
+                               flavor="hive")
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--start_year", type=int, default=1986)
+    parser.add_argument("--end_year", type=int, default=2020)
+    parser.add_argument("--parquet_dir", type=str, default="netkeiba_parquet")
+    parser.add_argument("--batch_races", type=int, default=1000)
+    parser.add_argument("--base_url", type=str, default=scraper.URL_BASE)
+    parser.add_argument("--rate", type=float, default=1.0)
+    parser.add_argument("--max_rate", type=float, default=None)
+    parser.add_argument("--max_in_flight", type=int, default=4)
+    parser.add_argument("--cache_dir", type=str, default="html_cache")
+    parser.add_argument("--replay", action="store_true")
+    parser.add_argument("--incremental", action="store_true")
+    parser.add_argument("--missing_path", type=str, default="missing_race_ids.tsv")
+    parser.add_argument("--recheck_days", type=int, default=7)
+    parser.add_argument("--parse_workers", type=int, default=None)
+    parser.add_argument("--metrics_port", type=int, default=None)
+    parser.add_argument("--metrics_json", type=str, default=None)
+    parser.add_argument("--metrics_interval", type=float, default=60)
+    args = parser.parse_args()
+    # --replay はキャッシュしたページから読むので、キャッシュなしでは使えない
+    if args.replay and not args.cache_dir:
+        parser.error("--replay requires --cache_dir")
+    return args
+
+def get_exist_race_ids(start_year, end_year, parquet_dir):
+    path = os.path.join(parquet_dir, "race_info")
+    if not os.path.isdir(path):
+        return []
+    dataset = ds.dataset(path, format="parquet", partitioning=PARTITIONING)
+    table = dataset.to_table(columns=["race_id"],
+                             filter=(ds.field("year") >= start_year) & (ds.field("year") <= end_year))
+    return [str(id) for id in table.column("race_id").to_pylist()]
+
+def get_latest_race_ids(parquet_dir):
+    path = os.path.join(parquet_dir, "race_info")
+    if not os.path.isdir(path):
+        return {}
+    dataset = ds.dataset(path, format="parquet", partitioning=PARTITIONING)
+    return scraper.get_latest_race_ids(dataset.to_table(columns=["race_id"])
+                                       .column("race_id").to_pylist())
+
+def to_table(rows, schema):
+    columns = [pa.array(values, type=field.type) for field, values in zip(schema, zip(*rows))]
+    return pa.Table.from_arrays(columns, schema=schema)
+
+# バッチは _staging/<バッチ> に書き、3つのデータセットを全て書き終えたら COMMITTED を置いてから移す
+TABLE_NAMES = ("race_data", "payout", "race_info")
+COMMITTED = "COMMITTED"
+
+def get_staging_dir(parquet_dir):
+    return os.path.join(parquet_dir, "_staging")
+
+def move_batch(batch_dir, parquet_dir):
+    # race_info を最後に移すので、移している途中でも race_info にあるレースは他の行も揃っている
+    for name in TABLE_NAMES:
+        root = os.path.join(batch_dir, name)
+        for dirpath, _, filenames in os.walk(root):
+            target = os.path.join(parquet_dir, name, os.path.relpath(dirpath, root))
+            os.makedirs(target, exist_ok=True)
+            for filename in filenames:
+                os.replace(os.path.join(dirpath, filename), os.path.join(target, filename))
+    shutil.rmtree(batch_dir)
+
+def recover_parquet(parquet_dir):
+    # COMMITTED のあるバッチは移している途中で落ちたので残りを移し、ないバッチは書きかけなので捨てる
+    staging_dir = get_staging_dir(parquet_dir)
+    if not os.path.isdir(staging_dir):
+        return
+    for batch in sorted(os.listdir(staging_dir)):
+        batch_dir = os.path.join(staging_dir, batch)
+        if os.path.isfile(os.path.join(batch_dir, COMMITTED)):
+            move_batch(batch_dir, parquet_dir)
+            print("\033[31mFinished moving batch %s in %s\033[0m" % (batch, parquet_dir))
+        else:
+            shutil.rmtree(batch_dir)
+            print("\033[31mRemoved an incomplete batch %s in %s\033[0m" % (batch, parquet_dir))
+
+class ParquetWriter:
+    # batch_races レース分ずつ、年・開催場所で分けたファイルとして追記する
+    def __init__(self, parquet_dir, batch_races=1000):
+        self.parquet_dir = parquet_dir
+        self.batch_races = batch_races
+        self.info_rows = []
+        self.data_rows = []
+        self.payout_rows = []
+
+    def insert(self, race_info, race_records, payouts):
+        self.info_rows.append(race_info)
+        self.data_rows += [record + (race_info.year, race_info.venue) for record in race_records]
+        self.payout_rows += [payout + (race_info.year, race_info.venue) for payout in payouts]
+        print("Inserted race_id %s" % race_info.race_id)
+        if len(self.info_rows) >= self.batch_races:
+            self.flush()
+
+    def write(self, batch_dir, name, rows, schema):
+        basename = "part-%s-{i}.parquet" % uuid.uuid4().hex
+        ds.write_dataset(to_table(rows, schema), os.path.join(batch_dir, name),
+                         format="parquet", partitioning=PARTITIONING,
+                         basename_template=basename,
+                         existing_data_behavior="overwrite_or_ignore")
+
+    def flush(self):
+        # 3つのデータセットを揃えてから移すので、途中で落ちても片方だけの行は残らない
+        if self.info_rows:
+            batch_dir = os.path.join(get_staging_dir(self.parquet_dir), uuid.uuid4().hex)
+            if self.data_rows:
+                self.write(batch_dir, "race_data", self.data_rows, RACE_DATA_SCHEMA)
+            if self.payout_rows:
+                self.write(batch_dir, "payout", self.payout_rows, PAYOUT_SCHEMA)
+            self.write(batch_dir, "race_info", self.info_rows, RACE_INFO_SCHEMA)
+            open(os.path.join(batch_dir, COMMITTED), "w").close()
+            move_batch(batch_dir, self.parquet_dir)
+        self.info_rows = []
+        self.data_rows = []
+        self.payout_rows = []
+
+def scraping(start_year, end_year, parquet_dir, batch_races=1000, rate=1.0, max_in_flight=4,
+             cache_dir="html_cache", replay=False,
+             missing_path="missing_race_ids.tsv", recheck_days=7, parse_workers=None,
+             incremental=False, base_url=scraper.URL_BASE, max_rate=None):
+    if incremental:
+        print("Start scraping new races")
+    else:
+        print("Start scraping data from %d to %d" % (start_year, end_year))
+
+    # 前回書き込み途中で落ちたバッチを片付けてから、保存済みのレースを読む
+    recover_parquet(parquet_dir)
+    exist_race_ids = get_exist_race_ids(start_year, end_year, parquet_dir)
+    store = HtmlStore(cache_dir) if cache_dir else None
+    stats = {}
+    if replay:
+        races = store.replay_races(start_year, end_year, exist_race_ids)
+    elif incremental:
+        # 未開催のレースはすぐに存在するようになるので、存在しなかった race_id の記録は使わない
+        fetcher = Fetcher(rate, max_in_flight, store, base_url=base_url, max_rate=max_rate)
+        races = fetcher.discover_races_after(get_latest_race_ids(parquet_dir), start_year,
+                                             time.localtime().tm_year, stats)
+    else:
+        missing = MissingRaceIds(missing_path, recheck_days) if missing_path else None
+        fetcher = Fetcher(rate, max_in_flight, store, missing, base_url=base_url, max_rate=max_rate)
+        races = fetcher.discover_races(start_year, end_year, exist_race_ids, stats)
+
+    writer = ParquetWriter(parquet_dir, batch_races)
+    try:
+        for race_id, result in tqdm(pipeline.parse_races(races, parse_workers)):
+            if result is None:
+                continue
+            race_info, race_records, payouts = result
+            with metrics.timer("write"):
+                writer.insert(race_info, race_records, payouts)
+            metrics.inc("races_written_total")
+            metrics.inc("rows_written_total", len(race_records))
+    finally:
+        writer.flush()
+
+    if not replay:
+        print("Probed %d of %d candidate race_ids (skipped %d), sent %d requests"
+              % (stats.get("probed", 0), stats.get("candidates", 0), stats.get("skipped", 0),
+                 fetcher.requests))
+
+if __name__ == "__main__":
+    ARGS = get_args()
+    metrics.start(ARGS.metrics_port, ARGS.metrics_json, ARGS.metrics_interval)
+    scraping(ARGS.start_year, ARGS.end_year, ARGS.parquet_dir, ARGS.batch_races,
+             ARGS.rate, ARGS.max_in_flight, ARGS.cache_dir, ARGS.replay,
+             ARGS.missing_path, ARGS.recheck_days, ARGS.parse_workers, ARGS.incremental,
+             ARGS.base_url, ARGS.max_rate)
+    if ARGS.metrics_json:
+        metrics.dump_json(ARGS.metrics_json)
@@ -2,17 +2,56 @@
 # coding: utf-8
 
 import argparse
+import datetime
 import sqlite3
 import time
 from tqdm import tqdm
+import metrics
+import pipeline
 import scraper
+from cache import HtmlStore, MissingRaceIds, PageValidators
+from fetcher import Fetcher
+from jobs import JobQueue, LeaseLost, SharedRateLimiter
+
+RACE_RESULT_COLUMNS = [
+    "race_id", "horse_key", "rank", "slot", "horse_num", "horse_gender", "horse_age",
+    "jockey_weight", "jockey_key", "goal_time", "last_time", "odds", "popularity",
+    "horse_weight", "horse_weight_diff", "trainer_key", "prize", "odds_place",
+]
 
 def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--start_year", type=int, default=1986)
     parser.add_argument("--end_year", type=int, default=2020)
     parser.add_argument("--dbpath", type=str, default="netkeiba.db")
-    return parser.parse_args()
+    parser.add_argument("--base_url", type=str, default=scraper.URL_BASE)
+    parser.add_argument("--rate", type=float, default=1.0)
+    parser.add_argument("--max_rate", type=float, default=None)
+    parser.add_argument("--max_in_flight", type=int, default=4)
+    parser.add_argument("--cache_dir", type=str, default="html_cache")
+    parser.add_argument("--replay", action="store_true")
+    parser.add_argument("--incremental", action="store_true")
+    parser.add_argument("--refresh_weeks", type=int, default=None)
+    parser.add_argument("--validators_path", type=str, default="page_validators.tsv")
+    parser.add_argument("--missing_path", type=str, default="missing_race_ids.tsv")
+    parser.add_argument("--recheck_days", type=int, default=7)
+    parser.add_argument("--parse_workers", type=int, default=None)
+    parser.add_argument("--job_path", type=str, default=None)
+    parser.add_argument("--lease_seconds", type=float, default=300)
+    parser.add_argument("--max_attempts", type=int, default=3)
+    parser.add_argument("--metrics_port", type=int, default=None)
+    parser.add_argument("--metrics_json", type=str, default=None)
+    parser.add_argument("--metrics_interval", type=float, default=60)
+    parser.add_argument("--commit_races", type=int, default=100)
+    parser.add_argument("--commit_seconds", type=float, default=10.0)
+    args = parser.parse_args()
+    # --replay はキャッシュしたページから読むので、キャッシュなしでは使えない
+    if args.replay and not args.cache_dir:
+        parser.error("--replay requires --cache_dir")
+    # --replay はリクエストを送らないので、再検証はできない
+    if args.replay and args.refresh_weeks:
+        parser.error("--replay cannot be used with --refresh_weeks")
+    return args
 
 def init_database(dbpath):
     print("Initializing database")
@@ -58,74 +97,402 @@ def init_database(dbpath):
             tierce_population           TEXT
         )
     """)
+    # 馬・騎手・調教師は別テーブルに1行ずつ持ち、race_result からは整数のキーで参照する
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS horse (
+            horse_key  INTEGER PRIMARY KEY,
+            horse_id   TEXT UNIQUE,
+            horse_name TEXT
+        )
+    """)
+    # 馬のページから取得したプロフィール（scraping_horse.py）と取得した時刻
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(horse)")]
+    for column in scraper.HORSE_COLUMNS[2:] + ["fetched_at"]:
+        if column not in columns:
+            column_type = "INTEGER" if column == "active" else "REAL" if column == "fetched_at" else "TEXT"
+            cursor.execute("ALTER TABLE horse ADD COLUMN %s %s" % (column, column_type))
+    # 外国馬の馬IDには英字が含まれる（例: 000a00fc5b）ので、以前の INTEGER の列は TEXT にする
+    if any(row[1] == "horse_id" and row[2] == "INTEGER"
+           for row in cursor.execute("PRAGMA table_info(horse)")):
+        migrate_horse_id(cursor)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS jockey (
+            jockey_key  INTEGER PRIMARY KEY,
+            jockey_id   TEXT UNIQUE,
+            jockey_name TEXT
+        )
+    """)
     cursor.execute("""
-        CREATE TABLE IF NOT EXISTS race_data (
+        CREATE TABLE IF NOT EXISTS trainer (
+            trainer_key  INTEGER PRIMARY KEY,
+            trainer_id   TEXT UNIQUE,
+            trainer_name TEXT
+        )
+    """)
+    # result_id は置き換えたレースの行にも新しい値を振るので、features.py はそれより後の行だけを読み直せる
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS race_result (
+            result_id         INTEGER PRIMARY KEY AUTOINCREMENT,
             race_id           INTEGER,
-            horse_id          INTEGER,
+            horse_key         INTEGER REFERENCES horse,
             rank              INTEGER,
             slot              INTEGER,
             horse_num         INTEGER,
-            horse_name        TEXT,
             horse_gender      TEXT,
             horse_age         INTEGER,
             jockey_weight     REAL,
-            jockey_name       TEXT,
+            jockey_key        INTEGER REFERENCES jockey,
             goal_time         REAL,
             last_time         REAL,
             odds              REAL,
             popularity        INTEGER,
             horse_weight      REAL,
             horse_weight_diff REAL,
-            trainer           TEXT,
+            trainer_key       INTEGER REFERENCES trainer,
             prize             REAL,
             odds_place        REAL
         )
     """)
+    if "result_id" not in [row[1] for row in cursor.execute("PRAGMA table_info(race_result)")]:
+        migrate_result_id(cursor)
+    # 払い戻しは (券種, 組み合わせ) ごとに1行
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS payout (
+            race_id     INTEGER,
+            bet_type    TEXT,
+            combination INTEGER,
+            payout      INTEGER,
+            popularity  INTEGER,
+            PRIMARY KEY (race_id, bet_type, combination)
+        ) WITHOUT ROWID
+    """)
+    # race_id・馬・騎手・日付で引くための索引（既にあるデータベースにも追加される）
+    cursor.execute("CREATE INDEX IF NOT EXISTS race_result_race_id ON race_result (race_id)")
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS race_result_horse ON race_result (horse_key, race_id)
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS race_result_jockey ON race_result (jockey_key, race_id)
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS race_info_date ON race_info (year, month, day, venue)
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS payout_bet_type ON payout (bet_type, race_id)")
+    cursor.execute("SELECT type FROM sqlite_master WHERE name = 'race_data'")
+    row = cursor.fetchone()
+    if row is not None and row[0] == "table":
+        migrate_race_data(cursor)
+    # 以前の race_data と同じ列を返すビュー
+    cursor.execute("""
+        CREATE VIEW IF NOT EXISTS race_data AS
+        SELECT r.race_id, h.horse_id, r.rank, r.slot, r.horse_num, h.horse_name,
+               r.horse_gender, r.horse_age, r.jockey_weight, j.jockey_name,
+               r.goal_time, r.last_time, r.odds, r.popularity,
+               r.horse_weight, r.horse_weight_diff, t.trainer_name AS trainer,
+               r.prize, r.odds_place, j.jockey_id, t.trainer_id
+        FROM race_result r
+        JOIN horse h ON h.horse_key = r.horse_key
+        LEFT JOIN jockey j ON j.jockey_key = r.jockey_key
+        LEFT JOIN trainer t ON t.trainer_key = r.trainer_key
+    """)
     connection.commit()
     connection.close()
 
+def drop_race_data_view(cursor):
+    # ビューが参照しているとテーブルの名前を変えられないので、消してから作り直す
+    cursor.execute("SELECT type FROM sqlite_master WHERE name = 'race_data'")
+    row = cursor.fetchone()
+    if row is not None and row[0] == "view":
+        cursor.execute("DROP VIEW race_data")
+
+def migrate_result_id(cursor):
+    # 以前の rowid をそのまま result_id にするので、features.py の保存した位置もそのまま使える
+    print("Migrating race_result to AUTOINCREMENT")
+    drop_race_data_view(cursor)
+    cursor.execute("ALTER TABLE race_result RENAME TO race_result_old")
+    cursor.execute("SELECT sql FROM sqlite_master WHERE name = 'race_result_old'")
+    definition = cursor.fetchone()[0]
+    columns = definition[definition.index("(") + 1:definition.rindex(")")]
+    cursor.execute("CREATE TABLE race_result (result_id INTEGER PRIMARY KEY AUTOINCREMENT, %s)"
+                   % columns)
+    cursor.execute("INSERT INTO race_result (result_id, %s) SELECT rowid, %s FROM race_result_old"
+                   % (", ".join(RACE_RESULT_COLUMNS), ", ".join(RACE_RESULT_COLUMNS)))
+    # 索引は race_result_old と一緒に消えるので、init_database が作り直す
+    cursor.execute("DROP TABLE race_result_old")
+
+def migrate_horse_id(cursor):
+    print("Migrating horse_id to TEXT")
+    columns = [(row[1], row[2]) for row in cursor.execute("PRAGMA table_info(horse)")]
+    definitions = ["horse_key INTEGER PRIMARY KEY", "horse_id TEXT UNIQUE"] \
+        + ["%s %s" % column for column in columns if column[0] not in ("horse_key", "horse_id")]
+    names = [name for name, _ in columns]
+    drop_race_data_view(cursor)
+    cursor.execute("CREATE TABLE horse_text (%s)" % ", ".join(definitions))
+    cursor.execute("INSERT INTO horse_text (%s) SELECT %s FROM horse" % (
+        ", ".join(names),
+        ", ".join("CAST(horse_id AS TEXT)" if name == "horse_id" else name for name in names)))
+    cursor.execute("DROP TABLE horse")
+    cursor.execute("ALTER TABLE horse_text RENAME TO horse")
+
+def migrate_race_data(cursor):
+    # 以前の形式の race_data テーブルを race_result と各テーブルに移す
+    # 騎手・調教師の ID は取っていなかったので、名前ごとに ID なしの行を作る
+    print("Migrating race_data")
+    cursor.execute("""
+        INSERT OR IGNORE INTO horse (horse_id, horse_name)
+        SELECT horse_id, MAX(horse_name) FROM race_data GROUP BY horse_id
+    """)
+    cursor.execute("""
+        INSERT INTO jockey (jockey_name)
+        SELECT DISTINCT jockey_name FROM race_data
+        WHERE jockey_name NOT IN (SELECT jockey_name FROM jockey WHERE jockey_id IS NULL)
+    """)
+    cursor.execute("""
+        INSERT INTO trainer (trainer_name)
+        SELECT DISTINCT trainer FROM race_data
+        WHERE trainer NOT IN (SELECT trainer_name FROM trainer WHERE trainer_id IS NULL)
+    """)
+    cursor.execute("""
+        INSERT INTO race_result (%s)
+        SELECT d.race_id, h.horse_key, d.rank, d.slot, d.horse_num, d.horse_gender,
+               d.horse_age, d.jockey_weight, j.jockey_key, d.goal_time, d.last_time,
+               d.odds, d.popularity, d.horse_weight, d.horse_weight_diff, t.trainer_key,
+               d.prize, d.odds_place
+        FROM race_data d
+        JOIN horse h ON h.horse_id = d.horse_id
+        LEFT JOIN jockey j ON j.jockey_id IS NULL AND j.jockey_name = d.jockey_name
+        LEFT JOIN trainer t ON t.trainer_id IS NULL AND t.trainer_name = d.trainer
+    """ % ", ".join(RACE_RESULT_COLUMNS))
+    cursor.execute("DROP TABLE race_data")
+
 def get_exist_race_ids(start_year, end_year, dbpath):
     connection = sqlite3.connect(dbpath)
     cursor = connection.cursor()
     cursor.execute("SELECT race_id FROM race_info WHERE year BETWEEN ? AND ?",
                    [start_year, end_year])
     exist_race_ids = [str(id[0]) for id in cursor.fetchall()]
+    connection.close()
     return exist_race_ids
 
-def insert_into_database(race_info, race_data, dbpath):
-    connection = sqlite3.connect(dbpath, isolation_level="EXCLUSIVE")
-    try:
-        race_info.to_sql(u"race_info", connection, if_exists="append", index=False)
-        race_data.to_sql(u"race_data", connection, if_exists="append", index=False)
-        connection.commit()
-        print("Inserted race_id %d" % race_info["race_id"])
-    except sqlite3.OperationalError as exception:
-        print("\033[31m")
-        print("Could not insert race_id %d" % race_info["race_id"])
-        print(exception)
-        print("\033[0m")
-        connection.rollback()
-    finally:
-        connection.close()
+def get_recent_race_ids(weeks, dbpath):
+    since = datetime.date.today() - datetime.timedelta(weeks=weeks)
+    connection = sqlite3.connect(dbpath)
+    cursor = connection.cursor()
+    cursor.execute("SELECT race_id FROM race_info WHERE year * 10000 + month * 100 + day >= ?",
+                   [since.year * 10000 + since.month * 100 + since.day])
+    race_ids = [str(id[0]) for id in cursor.fetchall()]
+    connection.close()
+    return race_ids
 
-def scraping(start_year, end_year, dbpath):
-    print("Start scraping data from %d to %d" % (start_year, end_year))
+def get_latest_race_ids(dbpath):
+    connection = sqlite3.connect(dbpath)
+    cursor = connection.cursor()
+    cursor.execute("SELECT MAX(race_id) FROM race_info GROUP BY venue")
+    race_ids = [id[0] for id in cursor.fetchall()]
+    connection.close()
+    return scraper.get_latest_race_ids(race_ids)
 
-    exist_race_ids = get_exist_race_ids(start_year, end_year, dbpath)
-    race_ids = sorted(list(set(scraper.get_race_ids(start_year, end_year)) - set(exist_race_ids)))
+class DatabaseWriter:
+    # 1本の接続を使い回し、commit_races レース分または commit_seconds 秒ごとにコミットする
+    # 1レース分の race_info と race_data は SAVEPOINT で囲み、途中までしか書かれないことはない
+    # コミットしたら、そのレースの race_id のリストで on_commit を呼ぶ
+    def __init__(self, dbpath, commit_races=100, commit_seconds=10.0, on_commit=None):
+        # 他のプロセスがコミットするまで待てるように timeout を長めにする
+        self.connection = sqlite3.connect(dbpath, timeout=60, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.commit_races = commit_races
+        self.commit_seconds = commit_seconds
+        self.on_commit = on_commit
+        self.pending = []
+        self.last_commit = time.time()
+        info_columns = scraper.RACE_INFO_COLUMNS + scraper.RACE_REFUND_COLUMNS
+        self.info_sql = "INSERT INTO race_info (%s) VALUES (%s)" \
+                        % (", ".join(info_columns), ", ".join("?" * len(info_columns)))
+        self.data_sql = "INSERT INTO race_result (%s) VALUES (%s)" \
+                        % (", ".join(RACE_RESULT_COLUMNS), ", ".join("?" * len(RACE_RESULT_COLUMNS)))
+        self.payout_sql = "INSERT INTO payout (%s) VALUES (%s)" \
+                          % (", ".join(scraper.PAYOUT_COLUMNS), ", ".join("?" * len(scraper.PAYOUT_COLUMNS)))
+        # (テーブル名, ID, 名前) -> キー
+        self.keys = {}
+
+    def get_key(self, cursor, table, id, name):
+        if id is None and name is None:
+            return None
+        key = self.keys.get((table, id, name))
+        if key is not None:
+            return key
+        if id is None:
+            select_sql = "SELECT {0}_key FROM {0} WHERE {0}_id IS NULL AND {0}_name = ?".format(table)
+            params = [name]
+        else:
+            select_sql = "SELECT {0}_key FROM {0} WHERE {0}_id = ?".format(table)
+            params = [id]
+        row = cursor.execute(select_sql, params).fetchone()
+        if row is None:
+            cursor.execute("INSERT INTO {0} ({0}_id, {0}_name) VALUES (?, ?)".format(table),
+                           [id, name])
+            key = cursor.lastrowid
+        else:
+            key = row[0]
+        self.keys[(table, id, name)] = key
+        return key
+
+    def get_rows(self, cursor, race_records):
+        rows = []
+        for record in race_records:
+            horse_key = self.get_key(cursor, "horse", record.horse_id, record.horse_name)
+            jockey_key = self.get_key(cursor, "jockey", record.jockey_id, record.jockey_name)
+            trainer_key = self.get_key(cursor, "trainer", record.trainer_id, record.trainer)
+            rows.append((record.race_id, horse_key, record.rank, record.slot, record.horse_num,
+                         record.horse_gender, record.horse_age, record.jockey_weight, jockey_key,
+                         record.goal_time, record.last_time, record.odds, record.popularity,
+                         record.horse_weight, record.horse_weight_diff, trainer_key,
+                         record.prize, record.odds_place))
+        return rows
+
+    def insert(self, race_info, race_records, payouts, replace=False):
+        # replace なら既に保存されているレースを置き換える
+        # 書き込めなかった場合は False を返す
+        race_id = race_info.race_id
+        cursor = self.connection.cursor()
+        if not self.connection.in_transaction:
+            cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute("SAVEPOINT race")
+        try:
+            if replace:
+                cursor.execute("DELETE FROM race_result WHERE race_id = ?", [race_id])
+                cursor.execute("DELETE FROM payout WHERE race_id = ?", [race_id])
+                cursor.execute("DELETE FROM race_info WHERE race_id = ?", [race_id])
+            cursor.execute(self.info_sql, race_info)
+            cursor.executemany(self.data_sql, self.get_rows(cursor, race_records))
+            cursor.executemany(self.payout_sql, payouts)
+            cursor.execute("RELEASE race")
+            self.pending.append(race_id)
+            inserted = True
+            print("Inserted race_id %s" % race_id)
+        except (sqlite3.OperationalError, sqlite3.IntegrityError) as exception:
+            cursor.execute("ROLLBACK TO race")
+            # 取り消した行のキーが残らないようにする
+            self.keys.clear()
+            cursor.execute("RELEASE race")
+            print("\033[31m")
+            print("Could not insert race_id %s" % race_id)
+            print(exception)
+            print("\033[0m")
+            inserted = False
+        if len(self.pending) >= self.commit_races \
+           or time.time() - self.last_commit >= self.commit_seconds:
+            self.commit()
+        return inserted
 
-    for race_id in tqdm(race_ids):
-        time_start = time.time()
-        soup = scraper.get_html(race_id)
+    def commit(self):
+        if self.connection.in_transaction:
+            self.connection.execute("COMMIT")
+        if self.on_commit is not None and self.pending:
+            self.on_commit(self.pending)
+        self.pending = []
+        self.last_commit = time.time()
 
-        if soup is not None:
-            df_race_info, df_race_records = scraper.collect_data(soup, race_id)
-            insert_into_database(df_race_info, df_race_records, dbpath)
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+def scraping(start_year, end_year, dbpath, rate=1.0, max_in_flight=4,
+             cache_dir="html_cache", replay=False,
+             missing_path="missing_race_ids.tsv", recheck_days=7, parse_workers=None,
+             commit_races=100, commit_seconds=10.0, incremental=False,
+             job_path=None, lease_seconds=300, max_attempts=3,
+             refresh_weeks=None, validators_path="page_validators.tsv",
+             base_url=scraper.URL_BASE, max_rate=None):
+    if incremental:
+        print("Start scraping new races")
+    elif refresh_weeks:
+        print("Start revalidating races in the last %d weeks" % refresh_weeks)
+    else:
+        print("Start scraping data from %d to %d" % (start_year, end_year))
+
+    exist_race_ids = get_exist_race_ids(start_year, end_year, dbpath)
+    store = HtmlStore(cache_dir) if cache_dir else None
+    validators = PageValidators(validators_path) if validators_path else None
+    stats = {}
+    jobs = None
+    if replay:
+        races = store.replay_races(start_year, end_year, exist_race_ids)
+    elif refresh_weeks:
+        fetcher = Fetcher(rate, max_in_flight, store, validators=validators,
+                          base_url=base_url, max_rate=max_rate)
+        races = fetcher.refresh_races(get_recent_race_ids(refresh_weeks, dbpath), stats)
+    elif incremental:
+        # 未開催のレースはすぐに存在するようになるので、存在しなかった race_id の記録は使わない
+        fetcher = Fetcher(rate, max_in_flight, store, validators=validators,
+                          base_url=base_url, max_rate=max_rate)
+        races = fetcher.discover_races_after(get_latest_race_ids(dbpath), start_year,
+                                             time.localtime().tm_year, stats)
+    elif job_path:
+        # 同じ job_path を指定したプロセス同士でシャードを分担し、リクエストの上限も共有する
+        jobs = JobQueue(job_path, lease_seconds, max_attempts)
+        jobs.add((y, v) for y in range(start_year, end_year + 1) for v in range(1, 11))
+        missing = MissingRaceIds(missing_path, recheck_days) if missing_path else None
+        fetcher = Fetcher(rate, max_in_flight, store, missing, SharedRateLimiter(job_path, rate),
+                          validators, base_url, max_rate)
+        races = fetcher.discover_jobs(jobs, lambda year: get_exist_race_ids(year, year, dbpath),
+                                      stats)
+    else:
+        missing = MissingRaceIds(missing_path, recheck_days) if missing_path else None
+        fetcher = Fetcher(rate, max_in_flight, store, missing, validators=validators,
+                          base_url=base_url, max_rate=max_rate)
+        races = fetcher.discover_races(start_year, end_year, exist_race_ids, stats)
+
+    # 再検証の検証子は、書き込みをコミットしてから保存する
+    writer = DatabaseWriter(dbpath, commit_races, commit_seconds,
+                            None if replay else fetcher.commit_validators)
+    try:
+        for race_id, result in tqdm(pipeline.parse_races(races, parse_workers)):
+            if isinstance(race_id, tuple):
+                # シャードのレースを全て書き込んだので、コミットしてから完了にする
+                writer.commit()
+                try:
+                    jobs.complete(race_id)
+                except LeaseLost as exception:
+                    print("\033[31m%s\033[0m" % exception)
+                continue
+            if result is None:
+                if not replay:
+                    fetcher.discard_validators([race_id])
+                continue
+            race_info, race_records, payouts = result
+            with metrics.timer("write"):
+                inserted = writer.insert(race_info, race_records, payouts, bool(refresh_weeks))
+            if not inserted:
+                metrics.inc("write_errors_total")
+                if not replay:
+                    fetcher.discard_validators([race_id])
+                continue
+            metrics.inc("races_written_total")
+            metrics.inc("rows_written_total", len(race_records))
+    finally:
+        writer.close()
+        if jobs is not None:
+            jobs.close()
 
-        elapsed_time = time.time() - time_start
-        time.sleep(max(1 - elapsed_time, 0))
+    if refresh_weeks:
+        print("Revalidated %d races (%d changed), sent %d requests"
+              % (stats.get("checked", 0), stats.get("changed", 0), fetcher.requests))
+    elif not replay:
+        print("Probed %d of %d candidate race_ids (skipped %d), sent %d requests"
+              % (stats.get("probed", 0), stats.get("candidates", 0), stats.get("skipped", 0),
+                 fetcher.requests))
 
 if __name__ == "__main__":
     ARGS = get_args()
+    metrics.start(ARGS.metrics_port, ARGS.metrics_json, ARGS.metrics_interval)
     init_database(ARGS.dbpath)
-    scraping(ARGS.start_year, ARGS.end_year, ARGS.dbpath)
+    scraping(ARGS.start_year, ARGS.end_year, ARGS.dbpath,
+             ARGS.rate, ARGS.max_in_flight, ARGS.cache_dir, ARGS.replay,
+             ARGS.missing_path, ARGS.recheck_days, ARGS.parse_workers,
+             ARGS.commit_races, ARGS.commit_seconds, ARGS.incremental,
+             ARGS.job_path, ARGS.lease_seconds, ARGS.max_attempts,
+             ARGS.refresh_weeks, ARGS.validators_path, ARGS.base_url, ARGS.max_rate)
+    if ARGS.metrics_json:
+        metrics.dump_json(ARGS.metrics_json)
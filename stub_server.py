@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from cache import HtmlStore
+
+# 存在しない race_id に対して netkeiba が返すのと同じく、結果の表がないページ
+MISSING_PAGE = """<html><head><meta charset="EUC-JP"></head><body>
+<div id="contents"><p>該当するレースがありません</p></div></body></html>""".encode("euc_jp")
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--corpus_dir", type=str, default=os.path.join("bench", "corpus"))
+    parser.add_argument("--existing_path", type=str, default=None)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--latency_sigma", type=float, default=0.0)
+    parser.add_argument("--error_rate", type=float, default=0.0)
+    parser.add_argument("--throttle_rate", type=float, default=None)
+    parser.add_argument("--seed", type=int, default=None)
+    return parser.parse_args()
+
+def get_corpus_race_ids(corpus):
+    # HtmlStore にある全ての race_id
+    years = [int(name) for name in os.listdir(corpus.root) if name.isdecimal()] \
+        if os.path.isdir(corpus.root) else []
+    return corpus.race_ids(min(years), max(years)) if years else []
+
+def load_existing(path):
+    # 1行に1つの race_id（タブ区切りなら先頭の列）
+    with open(path) as f:
+        return {line.split()[0] for line in f if line.strip()}
+
+class StubHandler(BaseHTTPRequestHandler):
+    # keep-alive の接続を使い回せるようにする
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self.send(200, json.dumps(self.server.get_stats()).encode(), "application/json")
+            return
+        status, body, headers = self.server.respond(self.path.rstrip("/").split("/")[-1],
+                                                    self.headers.get("If-None-Match"))
+        self.send(status, body, "text/html; charset=EUC-JP", headers)
+
+    def send(self, status, body, content_type, headers=()):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in headers:
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class StubServer(ThreadingHTTPServer):
+    # netkeiba の代わりに HtmlStore のページを返すローカルの HTTP サーバ
+    # existing にある race_id にはページを、それ以外には表のないページを返す
+    # corpus にない race_id には corpus のページを race_id で決まるように選んで返す
+    # latency 秒（latency_sigma > 0 なら中央値が latency の対数正規分布）待ってから応答し、
+    # error_rate の確率で 503 を、throttle_rate 回/秒を超えたリクエストには 429 を返す
+    daemon_threads = True
+
+    def __init__(self, corpus_dir, existing=None, latency=0.0, latency_sigma=0.0, error_rate=0.0,
+                 throttle_rate=None, host="127.0.0.1", port=0, seed=None):
+        super().__init__((host, port), StubHandler)
+        self.corpus = HtmlStore(corpus_dir)
+        self.corpus_race_ids = get_corpus_race_ids(self.corpus)
+        if not self.corpus_race_ids:
+            raise ValueError("No pages in %s" % corpus_dir)
+        self.existing = set(self.corpus_race_ids) if existing is None else set(existing)
+        self.latency = latency
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.tokens = throttle_rate or 0
+        self.timestamp = time.monotonic()
+        self.counts = {}
+        self.request_times = []
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return "http://%s:%d/race/" % (host, port)
+
+    def handle_error(self, request, client_address):
+        # タイムアウトしたクライアントが先に切断した場合は無視する
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def get_page(self, race_id):
+        content = self.corpus.get(race_id)
+        if content is None:
+            digest = hashlib.sha1(race_id.encode()).digest()
+            content = self.corpus.get(self.corpus_race_ids[
+                int.from_bytes(digest[:4], "big") % len(self.corpus_race_ids)])
+        return content
+
+    def throttled(self):
+        # RateLimiter と同じトークンバケットで、トークンがなければ待たせずに断る
+        if self.throttle_rate is None:
+            return False
+        now = time.monotonic()
+        self.tokens = min(self.throttle_rate, self.tokens + (now - self.timestamp) * self.throttle_rate)
+        self.timestamp = now
+        if self.tokens < 1:
+            return True
+        self.tokens -= 1
+        return False
+
+    def respond(self, race_id, etag=None):
+        with self.lock:
+            self.request_times.append(time.monotonic())
+            throttled = self.throttled()
+            error = self.random.random() < self.error_rate
+            latency = self.latency
+            if self.latency_sigma > 0:
+                latency *= self.random.lognormvariate(0, self.latency_sigma)
+        if throttled:
+            result = "throttled", 429, b"Too Many Requests", [("Retry-After", "1")]
+        else:
+            time.sleep(latency)
+            if error:
+                result = "error", 503, b"Service Unavailable", []
+            elif race_id in self.existing:
+                content = self.get_page(race_id)
+                digest = '"%s"' % hashlib.sha1(content).hexdigest()
+                if etag == digest:
+                    result = "not_modified", 304, b"", [("ETag", digest)]
+                else:
+                    result = "race", 200, content, [("ETag", digest)]
+            else:
+                result = "missing", 200, MISSING_PAGE, []
+        with self.lock:
+            self.counts[result[0]] = self.counts.get(result[0], 0) + 1
+        return result[1:]
+
+    def get_stats(self):
+        # 種類ごとのリクエスト数と、どの1秒間でも受けたリクエスト数の最大
+        with self.lock:
+            times = list(self.request_times)
+            stats = dict(self.counts)
+        peak = 0
+        start = 0
+        for end in range(len(times)):
+            while times[end] - times[start] >= 1:
+                start += 1
+            peak = max(peak, end - start + 1)
+        stats["requests"] = len(times)
+        stats["peak_per_sec"] = peak
+        return stats
+
+if __name__ == "__main__":
+    ARGS = get_args()
+    existing = load_existing(ARGS.existing_path) if ARGS.existing_path else None
+    server = StubServer(ARGS.corpus_dir, existing, ARGS.latency, ARGS.latency_sigma,
+                        ARGS.error_rate, ARGS.throttle_rate, ARGS.host, ARGS.port, ARGS.seed)
+    print("Serving %d races at %s" % (len(server.existing), server.base_url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(json.dumps(server.get_stats()))
@@ -0,0 +1,21 @@
+import os
+import check_parser
+import scraper
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            check_parser.FIXTURES_DIR)
+
+def test_fixtures_match_expected_output():
+    assert check_parser.check_fixtures(FIXTURES_DIR, scraper.PARSER) == []
+    assert check_parser.check_fixtures(FIXTURES_DIR, "html.parser") == []
+
+def test_payout_ties_keep_every_winner():
+    with open(os.path.join(FIXTURES_DIR, "payout_ties.html"), "rb") as f:
+        _, race_records, payouts = check_parser.parse(f.read(), "201905021204", scraper.PARSER)
+    assert [record.rank for record in race_records[:2]] == [1, 1]
+    assert [payout.combination for payout in payouts if payout.bet_type == "win"] == [1, 2]
+
+def test_pages_without_result_table_are_not_parsed():
+    for name in ("cancelled_race", "missing_table"):
+        with open(os.path.join(FIXTURES_DIR, name + ".html"), "rb") as f:
+            assert check_parser.parse(f.read(), "201103020101", scraper.PARSER) is None
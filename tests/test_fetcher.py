@@ -0,0 +1,118 @@
+import random
+import fetcher
+import scraper
+
+class FakeResponse:
+    def __init__(self, status_code, content=b"", headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+RACE_PAGE = b'<table class="race_table_01 nk_tb_common">'
+HORSE_PAGE = b'<table class="db_prof_table">'
+
+def test_classify():
+    assert fetcher.classify(FakeResponse(200, RACE_PAGE)) == "exists"
+    assert fetcher.classify(FakeResponse(200, b"<html></html>")) == "missing"
+    assert fetcher.classify(FakeResponse(304)) == "exists"
+    assert fetcher.classify(FakeResponse(429)) == "throttled"
+    assert fetcher.classify(FakeResponse(403)) == "throttled"
+    assert fetcher.classify(FakeResponse(503)) == "transient"
+    assert fetcher.classify(FakeResponse(408)) == "transient"
+    assert fetcher.classify(FakeResponse(404)) == "fatal"
+    assert fetcher.classify(FakeResponse(400)) == "fatal"
+
+def test_classify_horse_page():
+    assert fetcher.classify(FakeResponse(200, HORSE_PAGE), scraper.has_horse_profile) == "exists"
+    assert fetcher.classify(FakeResponse(200, RACE_PAGE), scraper.has_horse_profile) == "missing"
+
+def get_controller(rate=1.0, max_rate=4.0):
+    limiter = fetcher.RateLimiter(rate)
+    return limiter, fetcher.AimdController(limiter, max_rate)
+
+def test_aimd_reaches_max_rate_with_steady_latency():
+    rng = random.Random(0)
+    limiter, controller = get_controller()
+    for _ in range(2000):
+        controller.observe("exists", 0.2 * rng.lognormvariate(0, 0.5))
+    assert limiter.rate == 4.0
+
+def test_aimd_ignores_fast_missing_pages():
+    # 存在しないページは速く返るが、レースのページの応答時間の基準を下げない
+    rng = random.Random(0)
+    limiter, controller = get_controller()
+    for _ in range(2000):
+        if rng.random() < 0.4:
+            controller.observe("missing", 0.01)
+        else:
+            controller.observe("exists", 0.2 * rng.lognormvariate(0, 0.5))
+    assert limiter.rate == 4.0
+
+def test_aimd_halves_rate_when_throttled():
+    limiter, controller = get_controller(4.0)
+    controller.observe("throttled", 0.1)
+    assert limiter.rate == 2.0
+    # 下げた直後は window 件の間は続けて下げない
+    controller.observe("throttled", 0.1)
+    assert limiter.rate == 2.0
+
+def test_aimd_decreases_on_latency_spike():
+    limiter, controller = get_controller(4.0)
+    for _ in range(200):
+        controller.observe("exists", 0.2)
+    assert limiter.rate == 4.0
+    for _ in range(controller.window):
+        controller.observe("exists", 2.0)
+    assert limiter.rate < 4.0
+
+def test_aimd_decreases_on_transient_errors():
+    limiter, controller = get_controller(4.0)
+    for _ in range(17):
+        controller.observe("exists", 0.2)
+    for _ in range(3):
+        controller.observe("transient", 0.2)
+    assert limiter.rate == 2.0
+
+def test_aimd_keeps_min_rate():
+    limiter, controller = get_controller(1.0)
+    for _ in range(20):
+        for _ in range(controller.window):
+            controller.observe("fatal", 0.1)
+        controller.observe("throttled", 0.1)
+    assert limiter.rate == controller.min_rate
+
+def test_backoff_is_bounded():
+    f = fetcher.Fetcher(backoff_base=1.0, backoff_max=10.0)
+    for attempt in range(8):
+        for _ in range(100):
+            assert 0 <= f.get_backoff(attempt) <= min(10.0, 2 ** attempt)
+
+def test_backoff_respects_retry_after():
+    f = fetcher.Fetcher(backoff_base=1.0, backoff_max=10.0)
+    response = FakeResponse(429, headers={"Retry-After": "30"})
+    assert f.get_backoff(0, response) == 30.0
+    # 日付で指定された Retry-After は使わない
+    response = FakeResponse(429, headers={"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"})
+    assert f.get_backoff(0, response) <= 1.0
+
+def test_get_max_rate():
+    assert fetcher.get_max_rate(1.0) == 1.0
+    assert fetcher.get_max_rate(1.0, 2.0) == 2.0
+    assert fetcher.get_max_rate(3.0, 2.0) == 3.0
+
+class FakeValidators:
+    def __init__(self):
+        self.saved = {}
+
+    def set(self, race_id, etag, last_modified, digest):
+        self.saved[race_id] = (etag, last_modified, digest)
+
+def test_validators_are_saved_only_for_written_races():
+    validators = FakeValidators()
+    f = fetcher.Fetcher(validators=validators)
+    for race_id in ("201906050811", "201906050812"):
+        f.save_validators(race_id, FakeResponse(200, RACE_PAGE, {"ETag": race_id}))
+    f.discard_validators(["201906050812"])
+    f.commit_validators(["201906050811", "201906050812"])
+    assert list(validators.saved) == ["201906050811"]
+    assert f.pending_validators == {}
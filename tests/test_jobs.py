@@ -0,0 +1,32 @@
+import fetcher
+import jobs
+import scraper
+
+def test_release_fails_shard_after_max_attempts(tmp_path):
+    queue = jobs.JobQueue(str(tmp_path / "jobs.db"), max_attempts=2)
+    queue.add([(2019, 1)])
+    assert queue.claim() == (2019, 1)
+    queue.release()
+    assert queue.counts() == {"pending": 1}
+    assert queue.claim() == (2019, 1)
+    queue.release()
+    assert queue.counts() == {"failed": 1}
+    assert queue.claim() is None
+    queue.close()
+
+def test_failed_shard_is_released(tmp_path, monkeypatch):
+    def discover_venue_races(year, venue, fetch, exist_race_ids, stats):
+        raise fetcher.FetchError("url", "transient")
+        yield
+
+    monkeypatch.setattr(scraper, "discover_venue_races", discover_venue_races)
+    queue = jobs.JobQueue(str(tmp_path / "jobs.db"), max_attempts=3)
+    queue.add([(2019, 1)])
+    f = fetcher.Fetcher(max_in_flight=1)
+    stats = {}
+    # 取得できなかったシャードは、プロセスが終わるのを待たずに他のプロセスが借りられる
+    assert list(f.discover_jobs(queue, lambda year: [], stats)) == []
+    assert stats["failed_shards"] == 3
+    assert queue.counts() == {"failed": 1}
+    assert not queue.held
+    queue.close()
@@ -0,0 +1,27 @@
+import csv
+import io
+import os
+import check_parser
+import scraper
+import scraping
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            check_parser.FIXTURES_DIR)
+
+def to_lines(rows):
+    f = io.StringIO()
+    csv.writer(f, lineterminator="\n").writerows(rows)
+    return f.getvalue().splitlines()
+
+def test_to_rows_writes_legacy_format():
+    with open(os.path.join(FIXTURES_DIR, "normal_race.html"), "rb") as f:
+        race_info, race_records, _ = scraper.collect_data(scraper.parse_html(f.read()), "201906050811")
+    records = [race_records[0]._replace(horse_weight_diff=diff) for diff in (0, 4, -4, None)]
+    prefix = "201906050811,2019,3,8,中山,11,中山ステークス,ダ,右,2400,雪,良," \
+             "1,1,ホース1,牝,2,56.0,騎手31,93.0,35.7,21.7,1,"
+    assert to_lines(scraping.to_rows(race_info, records)) == [
+        prefix + "463,0,調教35",
+        prefix + "463,+4,調教35",
+        prefix + "463,-4,調教35",
+        prefix + "463,,調教35",
+    ]
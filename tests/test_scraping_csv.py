@@ -0,0 +1,80 @@
+import os
+import random
+import benchmark
+import scraper
+import scraping_csv
+
+def get_race(race_id):
+    content = benchmark.get_synthetic_page(race_id, "standard", random.Random(race_id))
+    return scraper.collect_data(scraper.parse_html(content.encode("euc_jp")), race_id)
+
+def get_csvpath(tmp_path):
+    return {key: str(tmp_path / ("netkeiba_%s.csv" % key)) for key in scraping_csv.CSV_KEYS}
+
+def write_races(csvpath, race_ids, on_commit=None):
+    writer = scraping_csv.CsvWriter(csvpath, commit_races=100, on_commit=on_commit)
+    races = {race_id: get_race(race_id) for race_id in race_ids}
+    for race_info, race_records, payouts in races.values():
+        writer.insert(race_info, race_records, payouts)
+    writer.close()
+    return races
+
+def test_commit_appends_all_files_and_index(tmp_path):
+    csvpath = get_csvpath(tmp_path)
+    committed = []
+    writer = scraping_csv.CsvWriter(csvpath, commit_races=100, on_commit=committed.extend)
+    race_info, race_records, payouts = get_race("201906050811")
+    writer.insert(race_info, race_records, payouts)
+    # commit_races に達するまでは書き込まない
+    assert not os.path.isfile(csvpath["info"])
+    writer.commit()
+    assert committed == ["201906050811"]
+    assert not os.path.isfile(scraping_csv.get_journal_path(csvpath))
+    rows = scraping_csv.get_race_rows("201906050811", csvpath)
+    assert len(rows["info"]) == 1
+    assert len(rows["data"]) == len(race_records)
+    assert len(rows["payout"]) == len(payouts)
+    assert rows["data"][0][1] == race_records[0].horse_id
+
+def test_get_race_rows_reads_each_race(tmp_path):
+    csvpath = get_csvpath(tmp_path)
+    races = write_races(csvpath, ["201906050811", "201906050812", "201905021204"])
+    index = scraping_csv.read_index(csvpath)
+    assert sorted(index) == sorted(races)
+    for race_id, (race_info, race_records, _) in races.items():
+        rows = scraping_csv.get_race_rows(race_id, csvpath, index)
+        assert {row[0] for row in rows["data"]} == {race_id}
+        assert len(rows["data"]) == len(race_records)
+        assert index[race_id][0] == race_info.year * 10000 + race_info.month * 100 + race_info.day
+    assert scraping_csv.get_race_rows("201901010101", csvpath, index) is None
+
+def test_recover_csv_rolls_back_incomplete_batch(tmp_path):
+    csvpath = get_csvpath(tmp_path)
+    write_races(csvpath, ["201906050811"])
+    sizes = scraping_csv.get_sizes(csvpath)
+    # data の csv だけを書いたところで落ちたバッチ
+    with open(scraping_csv.get_journal_path(csvpath), "w") as f:
+        f.write(" ".join(str(size) for size in sizes))
+    _, race_records, _ = get_race("201906050812")
+    scraping_csv.append_file(csvpath["data"], scraping_csv.to_bytes(race_records))
+    scraping_csv.recover_csv(csvpath)
+    assert scraping_csv.get_sizes(csvpath) == sizes
+    assert not os.path.isfile(scraping_csv.get_journal_path(csvpath))
+    assert scraping_csv.get_race_rows("201906050812", csvpath) is None
+    assert scraping_csv.get_race_rows("201906050811", csvpath) is not None
+
+def test_build_index_matches_committed_index(tmp_path):
+    csvpath = get_csvpath(tmp_path)
+    write_races(csvpath, ["201906050811", "201906050812"])
+    index = scraping_csv.read_index(csvpath)
+    os.remove(scraping_csv.get_index_path(csvpath))
+    scraping_csv.build_index(csvpath)
+    assert scraping_csv.read_index(csvpath) == index
+
+def test_index_is_rebuilt_after_csv_is_rewritten(tmp_path):
+    csvpath = get_csvpath(tmp_path)
+    write_races(csvpath, ["201906050811", "201906050812"])
+    race_info, race_records, payouts = get_race("201906050811")
+    scraping_csv.upsert_into_csv([(race_info, race_records[:3], payouts)], csvpath)
+    assert len(scraping_csv.get_race_rows("201906050811", csvpath)["data"]) == 3
+    assert scraping_csv.get_race_rows("201906050812", csvpath) is not None
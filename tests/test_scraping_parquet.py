@@ -0,0 +1,61 @@
+import os
+import random
+import shutil
+import pyarrow.dataset as ds
+import benchmark
+import scraper
+import scraping_parquet
+
+def get_race(race_id):
+    content = benchmark.get_synthetic_page(race_id, "standard", random.Random(race_id))
+    return scraper.collect_data(scraper.parse_html(content.encode("euc_jp")), race_id)
+
+def count_rows(parquet_dir, name):
+    path = os.path.join(parquet_dir, name)
+    if not os.path.isdir(path):
+        return 0
+    return ds.dataset(path, format="parquet", partitioning=scraping_parquet.PARTITIONING).count_rows()
+
+def stage_batch(parquet_dir, race_id, monkeypatch):
+    # flush がバッチを移す前に落ちたときと同じ状態にする
+    moves = []
+    monkeypatch.setattr(scraping_parquet, "move_batch",
+                        lambda batch_dir, parquet_dir: moves.append(batch_dir))
+    writer = scraping_parquet.ParquetWriter(parquet_dir)
+    writer.insert(*get_race(race_id))
+    writer.flush()
+    monkeypatch.undo()
+    return moves[0]
+
+def test_flush_writes_all_tables(tmp_path):
+    parquet_dir = str(tmp_path)
+    writer = scraping_parquet.ParquetWriter(parquet_dir)
+    race_info, race_records, payouts = get_race("201906050811")
+    writer.insert(race_info, race_records, payouts)
+    writer.flush()
+    assert scraping_parquet.get_exist_race_ids(2019, 2019, parquet_dir) == ["201906050811"]
+    assert count_rows(parquet_dir, "race_data") == len(race_records)
+    assert count_rows(parquet_dir, "payout") == len(payouts)
+    assert os.listdir(scraping_parquet.get_staging_dir(parquet_dir)) == []
+
+def test_recover_removes_uncommitted_batch(tmp_path, monkeypatch):
+    parquet_dir = str(tmp_path)
+    batch_dir = stage_batch(parquet_dir, "201906050811", monkeypatch)
+    os.remove(os.path.join(batch_dir, scraping_parquet.COMMITTED))
+    scraping_parquet.recover_parquet(parquet_dir)
+    assert not os.path.isdir(batch_dir)
+    assert count_rows(parquet_dir, "race_data") == 0
+    assert scraping_parquet.get_exist_race_ids(2019, 2019, parquet_dir) == []
+
+def test_recover_finishes_committed_batch(tmp_path, monkeypatch):
+    parquet_dir = str(tmp_path)
+    batch_dir = stage_batch(parquet_dir, "201906050811", monkeypatch)
+    # race_data だけを移したところで落ちた
+    shutil.move(os.path.join(batch_dir, "race_data"), os.path.join(parquet_dir, "race_data"))
+    assert scraping_parquet.get_exist_race_ids(2019, 2019, parquet_dir) == []
+    scraping_parquet.recover_parquet(parquet_dir)
+    _, race_records, payouts = get_race("201906050811")
+    assert not os.path.isdir(batch_dir)
+    assert scraping_parquet.get_exist_race_ids(2019, 2019, parquet_dir) == ["201906050811"]
+    assert count_rows(parquet_dir, "race_data") == len(race_records)
+    assert count_rows(parquet_dir, "payout") == len(payouts)